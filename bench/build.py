@@ -0,0 +1,365 @@
+"""
+Benchmark of the build phases on synthetic sites
+
+Generates reproducible synthetic sites (pages with Markdown bodies of a given size, a chain of extended templates
+and a number of plugins) in a temporary dir and times the phases of a build separately in a fresh process:
+load_raw_entries, convert_raw_entries, Builder.prepare, Builder.build_nav, the batch loop (page loading,
+resolve_references, process_text_auto, Builder.build) and log.write, along with the peak memory.
+Each site is built cold (without log, caches and output), again without changes (no-op)
+and after editing a single page.
+
+    python bench/build.py --pages 1000 10000 100000 --output results.json
+    python bench/build.py --pages 1000 --baseline results.json --threshold 0.2
+
+With a baseline, every phase (and the total) slower than the baseline by more than the threshold
+(and by more than --min-seconds, to ignore noise of very short phases) is reported and the exit code is 1.
+"""
+import argparse
+import inspect
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CHE_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+SCENARIOS = ['cold', 'noop', 'edit']
+
+# Phases in the order of a build, the batch loop phases are summed up over all batches
+PHASES = ['load_raw_entries', 'convert_raw_entries', 'prepare', 'build_nav', 'load_pages', 'resolve_references',
+          'process_text_auto', 'build', 'write']
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt labore dolore magna '
+         'aliqua enim minim veniam quis nostrud exercitation ullamco laboris nisi aliquip commodo consequat duis aute '
+         'irure reprehenderit voluptate velit esse cillum fugiat nulla pariatur excepteur sint occaecat cupidatat '
+         'proident sunt culpa officia deserunt mollit anim laborum').split()
+
+PLUGIN_SOURCE = '''from plugin import Plugin
+
+
+class ChePlugin(Plugin):
+    version = 1
+
+    def install(self):
+        pass
+
+    def before_load(self, pair):
+        pair['page']['contents'] = pair['page']['contents'].replace(b'[[{name}]]', b'{name} was here')
+        return pair
+
+    def after_load(self, pair):
+        return pair
+'''
+
+
+def _markdown(rng, name, pages, words):
+    """
+    Returns a Markdown body of about the given number of words with headings, lists and references to other pages
+    """
+    lines = ['# {0}'.format(name), '']
+    written = 0
+    while written < words:
+        if rng.random() < 0.1:
+            lines += ['## {0}'.format(' '.join(rng.choices(WORDS, k=3)).capitalize()), '']
+        if rng.random() < 0.2:
+            lines += ['- {0}'.format(' '.join(rng.choices(WORDS, k=5))) for _ in range(3)] + ['']
+            written += 15
+        sentences = []
+        for _ in range(rng.randint(2, 6)):
+            sentence = rng.choices(WORDS, k=rng.randint(6, 16))
+            if rng.random() < 0.2:
+                sentence.append('[{0}](page:page{1})'.format(rng.choice(WORDS), rng.randrange(pages)))
+            sentences.append(' '.join(sentence).capitalize() + '.')
+            written += len(sentence)
+        lines += [' '.join(sentences), '']
+    return '\n'.join(lines)
+
+
+def generate_site(path, pages, words=300, template_depth=3, plugins=0, backend='json', seed=1):
+    """
+    Generates a synthetic site with the given number of pages into path (its config is written as config2.yml)
+    The same arguments always generate the same site
+    """
+    import yaml
+    rng = random.Random(seed)
+
+    content_dir = os.path.join(path, 'content')
+    os.makedirs(content_dir)
+    for i in range(pages):
+        name = 'page{0}'.format(i)
+        meta = {'title': 'Page {0}'.format(i), 'slug': 'page-{0}'.format(i), 'template': 'default.html',
+                'visibility': 'visible', 'status': 'published'}
+        with open(os.path.join(content_dir, name + '.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        with open(os.path.join(content_dir, name + '.md'), 'w', encoding='utf-8') as page_file:
+            page_file.write(_markdown(rng, name, pages, words))
+            page_file.write(''.join('\n[[plugin{0}]]\n'.format(p) for p in range(plugins)))
+
+    # A chain of template_depth layouts, each one extending the previous one
+    templates_dir = os.path.join(path, 'templates')
+    os.makedirs(templates_dir)
+    templates = {'layout0.html': '<html><head><title>{{ page.title }}</title></head><body>'
+                                 '<nav>{% for n in nav %}<a href="{{ n.url }}">{{ n.title }}</a>{% endfor %}</nav>'
+                                 '{% block body %}{% block content %}{% endblock %}{% endblock %}</body></html>'}
+    for level in range(1, template_depth):
+        templates['layout{0}.html'.format(level)] = \
+            '{{% extends "layout{0}.html" %}}{{% block body %}}<div class="level{1}">{{{{ super() }}}}</div>{{% endblock %}}' \
+            .format(level - 1, level)
+    templates['default.html'] = '{{% extends "layout{0}.html" %}}{{% block content %}}<h1>{{{{ page.title }}}}</h1>' \
+                                '{{{{ page.content|safe }}}}<p class="summary">{{{{ page.summary }}}}</p>' \
+                                '{{% endblock %}}'.format(max(template_depth - 1, 0))
+    for template_name, source in templates.items():
+        with open(os.path.join(templates_dir, template_name), 'w', encoding='utf-8') as template_file:
+            template_file.write(source)
+
+    plugins_dir = os.path.join(path, 'plugins')
+    os.makedirs(plugins_dir)
+    open(os.path.join(plugins_dir, '__init__.py'), 'w').close()
+    for p in range(plugins):
+        plugin_dir = os.path.join(plugins_dir, 'plugin{0}'.format(p))
+        os.makedirs(plugin_dir)
+        open(os.path.join(plugin_dir, '__init__.py'), 'w').close()
+        with open(os.path.join(plugin_dir, 'plugin{0}.py'.format(p)), 'w', encoding='utf-8') as plugin_file:
+            plugin_file.write(PLUGIN_SOURCE.replace('{name}', 'plugin{0}'.format(p)))
+
+    config = {
+        'project': {'name': 'bench'},
+        'log': {'output_dir': 'store/', 'backend': backend, 'file_name': 'log.json', 'db_name': 'log.sqlite',
+                'hash_algorithm': 'md5'},
+        'files': {'meta_types': ['json'], 'page_types': ['md'], 'default_meta_type': 'json', 'default_page_type': 'md'},
+        'templates': {'path': 'templates/', 'build_nav': True, 'default_template': 'default.html'},
+        'input': {'input_dir': 'content/'},
+        'output': {'file_format': 'html', 'output_dir': 'dist/', 'minify_html': True},
+        'processing': {'workers': 1, 'batch_size': 1000, 'use_nltk': False, 'min_word_length': 2,
+                       'keyword_extraction': True, 'summary_generation': True, 'language': 'english',
+                       'keyword_count': 10, 'summary_sentences': 2, 'keyword_engine': 'frequency'},
+        'plugins': {'path': 'plugins'},
+        'assets': {'types': [], 'fingerprint': False, 'link': 'hardlink'},
+        'cache': {'render_cache': True, 'parse_cache': True}
+    }
+    with open(os.path.join(path, 'config2.yml'), 'w', encoding='utf-8') as config_file:
+        yaml.safe_dump(config, config_file, default_flow_style=False)
+
+
+def _clean_site(path):
+    for dir_name in ['store', 'dist']:
+        shutil.rmtree(os.path.join(path, dir_name), ignore_errors=True)
+
+
+def _edit_site(path, pages, run):
+    """
+    Appends a sentence to the page in the middle of the site
+    """
+    with open(os.path.join(path, 'content', 'page{0}.md'.format(pages // 2)), 'a', encoding='utf-8') as page_file:
+        page_file.write('\nEdited by run {0}.\n'.format(run))
+
+
+def _time_phase(timings, owner, attribute, phase):
+    """
+    Replaces owner.attribute by a wrapper adding its run time to timings[phase]
+    The run time of generators is the time spent in the generator itself, without the time of the consumer
+    """
+    function = getattr(owner, attribute)
+
+    if inspect.isgeneratorfunction(function):
+        def timed(*args, **kwargs):
+            generator = function(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+                yield item
+    else:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+    setattr(owner, attribute, timed)
+
+
+def measure(workers=1):
+    """
+    Builds the site in the current dir once, as che does, and returns the time of each phase, the total time
+    and the peak memory. Runs within a fresh process (see run_scenario()), as che reads its config on import
+    """
+    sys.path.insert(0, CHE_ROOT)
+    import che
+    from builder.build import Builder
+    from helpers import get_peak_memory
+    from hooks import add_subscriber, HOOK_BEFORE_LOAD, HOOK_AFTER_LOAD
+    from log import log
+    from plugin import PluginHandler
+
+    timings = {}
+    for owner, attribute, phase in [(log, 'load_raw_entries', 'load_raw_entries'),
+                                    (log, 'convert_raw_entries', 'convert_raw_entries'),
+                                    (Builder, 'prepare', 'prepare'),
+                                    (Builder, 'build_nav', 'build_nav'),
+                                    (Builder, 'batches', 'load_pages'),
+                                    (Builder, 'resolve_references', 'resolve_references'),
+                                    (Builder, 'process_text_auto', 'process_text_auto'),
+                                    (Builder, 'build', 'build'),
+                                    (log, 'write', 'write')]:
+        _time_phase(timings, owner, attribute, phase)
+
+    start = time.perf_counter()
+    che.plugin_handler = PluginHandler(che.config['plugins']['path'])
+    che.plugin_handler.install_plugins()
+    add_subscriber(che.plugin_handler, HOOK_BEFORE_LOAD, HOOK_AFTER_LOAD)
+
+    files, ok = log.load_raw_entries(che.config['input']['input_dir'], workers=workers)
+    built = che.build(files, ok, workers=workers)
+    total = time.perf_counter() - start
+
+    peak_memory, peak_memory_workers = get_peak_memory()
+    return {
+        'phases': {phase: round(timings.get(phase, 0), 4) for phase in PHASES},
+        'other': round(total - sum(timings.values()), 4),
+        'total': round(total, 4),
+        'built': len(built),
+        'peak_memory_mb': round(peak_memory or 0, 1),
+        'peak_memory_workers_mb': round(peak_memory_workers or 0, 1)
+    }
+
+
+def run_scenario(site_dir, workers=1, verbose=False):
+    """
+    Runs measure() in a fresh process within site_dir and returns its results
+    """
+    fd, result_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([CHE_ROOT, os.environ.get('PYTHONPATH', '')]))
+        subprocess.run([sys.executable, os.path.realpath(__file__), '--measure', result_path, '--workers', str(workers)],
+                       cwd=site_dir, env=env, check=True, stdout=None if verbose else subprocess.DEVNULL)
+        with open(result_path, encoding='utf-8') as result_file:
+            return json.load(result_file)
+    finally:
+        os.remove(result_path)
+
+
+def _best(results):
+    """
+    Returns the fastest of repeated results, phase by phase (the least disturbed by noise) and the highest peak memory
+    """
+    best = dict(results[0])
+    best['phases'] = {phase: min(r['phases'][phase] for r in results) for phase in PHASES}
+    for key in ['other', 'total']:
+        best[key] = min(r[key] for r in results)
+    for key in ['peak_memory_mb', 'peak_memory_workers_mb']:
+        best[key] = max(r[key] for r in results)
+    return best
+
+
+def run(sizes, words=300, template_depth=3, plugins=0, backend='json', workers=1, repeat=1, keep=False, verbose=False):
+    """
+    Runs all scenarios on a synthetic site of each of the given sizes
+    Returns the results by size and scenario
+    """
+    results = {}
+    for pages in sizes:
+        site_dir = tempfile.mkdtemp(prefix='che-bench-')
+        try:
+            start = time.perf_counter()
+            generate_site(site_dir, pages, words, template_depth, plugins, backend)
+            print('{0} pages generated in {1:.2f}s ({2})'.format(pages, time.perf_counter() - start, site_dir))
+
+            runs = {scenario: [] for scenario in SCENARIOS}
+            for i in range(repeat):
+                _clean_site(site_dir)
+                runs['cold'].append(run_scenario(site_dir, workers, verbose))
+                runs['noop'].append(run_scenario(site_dir, workers, verbose))
+                _edit_site(site_dir, pages, i)
+                runs['edit'].append(run_scenario(site_dir, workers, verbose))
+
+            results[str(pages)] = {scenario: _best(scenario_runs) for scenario, scenario_runs in runs.items()}
+            for scenario in SCENARIOS:
+                result = results[str(pages)][scenario]
+                print('{0:>8} {1:<5} {2:8.3f}s {3:8.1f} MB  {4}'.format(
+                    pages, scenario, result['total'], result['peak_memory_mb'],
+                    ' '.join('{0}={1:.3f}'.format(phase, t) for phase, t in result['phases'].items() if t >= 0.001)))
+        finally:
+            if not keep:
+                shutil.rmtree(site_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=0.2, min_seconds=0.05):
+    """
+    Compares results with a baseline (both as returned by run())
+    Returns a list of (pages, scenario, phase, baseline seconds, seconds) of all regressions
+    """
+    regressions = []
+    for pages, scenarios in results.items():
+        for scenario, result in scenarios.items():
+            base = baseline.get(pages, {}).get(scenario)
+            if not base:
+                continue
+            timings = dict(result['phases'], total=result['total'])
+            base_timings = dict(base['phases'], total=base['total'])
+            for phase, seconds in timings.items():
+                if phase not in base_timings:
+                    continue
+                if seconds > base_timings[phase] * (1 + threshold) and seconds - base_timings[phase] > min_seconds:
+                    regressions.append((pages, scenario, phase, base_timings[phase], seconds))
+    return regressions
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--pages', help='Sizes of the synthetic sites', type=int, nargs='+', default=[1000, 10000])
+    argparser.add_argument('--words', help='Words per Markdown page', type=int, default=300)
+    argparser.add_argument('--template-depth', help='Number of layouts extending each other', type=int, default=3)
+    argparser.add_argument('--plugins', help='Number of plugins', type=int, default=0)
+    argparser.add_argument('--backend', help='Log backend', choices=['json', 'sqlite'], default='json')
+    argparser.add_argument('--workers', help='Number of workers', type=int, default=1)
+    argparser.add_argument('--repeat', help='Runs per scenario, the fastest one is kept', type=int, default=1)
+    argparser.add_argument('--output', help='Write the results to this JSON file')
+    argparser.add_argument('--baseline', help='Compare the results with this JSON file (as written by --output)')
+    argparser.add_argument('--threshold', help='Allowed slowdown against the baseline (0.2 = 20%%)', type=float, default=0.2)
+    argparser.add_argument('--min-seconds', help='Slowdowns below this are never regressions', type=float, default=0.05)
+    argparser.add_argument('--keep', help='Keep the generated sites', action='store_true')
+    argparser.add_argument('--verbose', help='Show the output of the builds', action='store_true')
+    argparser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.measure:
+        # Internal: a single build within the site in the current dir, see run_scenario()
+        measured = measure(args.workers)
+        with open(args.measure, 'w', encoding='utf-8') as measure_file:
+            json.dump(measured, measure_file)
+        sys.exit()
+
+    bench_results = run(args.pages, args.words, args.template_depth, args.plugins, args.backend, args.workers,
+                        args.repeat, args.keep, args.verbose)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump({
+                'settings': {'words': args.words, 'template_depth': args.template_depth, 'plugins': args.plugins,
+                             'backend': args.backend, 'workers': args.workers, 'repeat': args.repeat},
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': bench_results
+            }, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            found_regressions = compare(bench_results, json.load(baseline_file)['results'], args.threshold, args.min_seconds)
+        for regression in found_regressions:
+            print('Regression: {0} pages {1} {2}: {3:.3f}s -> {4:.3f}s'.format(*regression))
+        print('{0} regressions (threshold {1:.0%})'.format(len(found_regressions), args.threshold))
+        if found_regressions:
+            sys.exit(1)
@@ -0,0 +1,51 @@
+"""
+Startup budget check for the no-op build path
+
+Imports che with python -X importtime inside a site directory (containing the site's config)
+and fails if the cumulative import time exceeds the budget.
+
+    python bench/importtime.py --site path/to/site --budget 250
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+CHE_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def measure_import_time(site_dir, module='che'):
+    """
+    Returns the cumulative import time of the module in ms and the (module, ms) pairs of all imports
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([CHE_ROOT, os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(module)],
+                            cwd=site_dir, env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            universal_newlines=True, check=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        imports.append((name.strip(), int(cumulative) / 1000))
+
+    total = next(ms for name, ms in reversed(imports) if name == module)
+    return total, imports
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--site', help='Site directory containing the config', default=os.curdir)
+    argparser.add_argument('--budget', help='Startup budget in ms', type=float, default=250)
+    argparser.add_argument('--top', help='Number of the slowest imports to show', type=int, default=10)
+    args = argparser.parse_args()
+
+    total, imports = measure_import_time(args.site)
+    for name, ms in sorted(imports, key=lambda i: i[1], reverse=True)[:args.top]:
+        print('{0:10.1f} ms  {1}'.format(ms, name))
+
+    print('Import time of che: {0:.1f} ms (budget {1:.1f} ms)'.format(total, args.budget))
+    if total > args.budget:
+        print('Startup budget exceeded')
+        sys.exit(1)
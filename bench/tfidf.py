@@ -0,0 +1,76 @@
+"""
+Benchmark of the TF-IDF keyword engine on a synthetic corpus
+
+Builds the index over a corpus with a Zipf distributed vocabulary, scores all pages, then updates a few pages
+incrementally and scores only those, as an incremental build would.
+
+    python bench/tfidf.py --pages 50000 --changed 100
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import numpy as np
+from tfidf import TfidfIndex
+
+
+def synthetic_corpus(pages, vocabulary=50000, tokens=300, seed=1):
+    """
+    Returns the token lists of the given number of pages, token ranks follow a Zipf distribution
+    """
+    random = np.random.default_rng(seed)
+    ranks = np.minimum(random.zipf(1.2, size=pages * tokens), vocabulary) - 1
+    lengths = random.integers(tokens // 2, tokens * 3 // 2, size=pages)
+    words = ['term{0}'.format(i) for i in range(vocabulary)]
+    corpus = []
+    offset = 0
+    for length in lengths.tolist():
+        corpus.append([words[r] for r in ranks[offset:offset + length].tolist()])
+        offset = (offset + length) % (len(ranks) - tokens * 2)
+    return corpus
+
+
+def timed(label, function, *args):
+    start = time.time()
+    result = function(*args)
+    print('{0:>28}: {1:8.3f}s'.format(label, time.time() - start))
+    return result
+
+
+def run(pages, changed, k=10):
+    corpus = timed('Generate corpus', synthetic_corpus, pages)
+    names = ['page{0}'.format(i) for i in range(pages)]
+    index = TfidfIndex(os.path.join(tempfile.mkdtemp(), 'tfidf.npz'))
+
+    def build():
+        for name, tokens in zip(names, corpus):
+            index.set_page(name, 'v1', tokens)
+
+    timed('Full index ({0} pages)'.format(pages), build)
+    timed('Top {0} terms of all pages'.format(k), index.top_terms, names, k)
+    timed('Save', index.save)
+    index = timed('Load', TfidfIndex.load, index.path)
+
+    changed_names = names[::max(1, pages // changed)][:changed]
+    keys = {name: 'v2' if name in changed_names else 'v1' for name in names}
+
+    def update():
+        stale = index.sync(keys)
+        for name in stale:
+            index.set_page(name, keys[name], list(reversed(corpus[(names.index(name) + 1) % pages])))
+        return index.top_terms(stale, k)
+
+    timed('Incremental ({0} pages)'.format(changed), update)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--pages', help='Number of synthetic pages', type=int, default=50000)
+    argparser.add_argument('--changed', help='Number of pages changed for the incremental update', type=int, default=100)
+    args = argparser.parse_args()
+
+    run(args.pages, args.changed)
@@ -0,0 +1,107 @@
+import os
+import re
+import shutil
+from termcolor import colored
+try:
+    from configuration import config
+except ImportError:
+    pass
+from helpers import safe_create_dir
+from log import log
+
+# Relative asset references within the rendered html, i.e. <img src="images/logo.png"> (or unquoted, as minified)
+# Urls with a scheme (http:, page:, data:, ...) are never matched
+ASSET_REFERENCE = re.compile(r'(?P<attr>href|src)=(?P<quote>["\']?)(?P<prefix>\.?/)?(?P<path>[^"\'#?:\s>]+)'
+                             r'(?P<suffix>[#?][^"\'\s>]*)?(?P=quote)')
+
+# ioctl request to clone (reflink) a file on copy-on-write file systems (btrfs, xfs) on Linux
+FICLONE = 0x40049409
+
+
+def _reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as source_open, open(target, 'wb') as target_open:
+        fcntl.ioctl(target_open.fileno(), FICLONE, source_open.fileno())
+
+
+def publish_file(source, target, link='hardlink'):
+    """
+    Publishes source to target by a hard link or a reflink, falling back to a copy
+    (i.e. across file systems or on file systems without reflinks)
+    Returns the method that has been used
+    """
+    safe_create_dir(target)
+    tmp_path = os.path.join(os.path.dirname(target), '.{0}.tmp'.format(os.path.basename(target)))
+    methods = {'hardlink': ['hardlink', 'reflink', 'copy'], 'reflink': ['reflink', 'copy']}.get(link, ['copy'])
+
+    for method in methods:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            if method == 'hardlink':
+                os.link(source, tmp_path)
+            elif method == 'reflink':
+                _reflink(source, tmp_path)
+            else:
+                shutil.copy2(source, tmp_path)
+            os.replace(tmp_path, target)
+            return method
+        except (OSError, ImportError):
+            if method == methods[-1]:
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+
+def publish_assets(found_assets, changed_assets, link='hardlink'):
+    """
+    Publishes the new and changed assets to the output dir, unchanged assets are only published again
+    if their output is missing (i.e. after cleaning the output dir)
+    Returns the number of published assets
+    """
+    asset_outputs = log.find_asset_outputs()
+    changed_assets = set(changed_assets)
+    methods = {}
+
+    for name, asset in found_assets.items():
+        target = os.path.join(config['output']['output_dir'], asset_outputs[name])
+        if name not in changed_assets and os.path.exists(target):
+            continue
+
+        method = publish_file(asset['path'], target, link)
+        methods[method] = methods.get(method, 0) + 1
+
+    published = sum(methods.values())
+    if found_assets:
+        print(colored('Assets', 'grey'), '-> {0} published, {1} unchanged'.format(published, len(found_assets) - published),
+              ', '.join('{0}: {1}'.format(method, count) for method, count in methods.items()))
+    return published
+
+
+def remove_asset_outputs(stale_outputs):
+    """
+    Removes the outputs of removed assets and the old fingerprinted outputs of changed assets
+    """
+    for output in stale_outputs:
+        target = os.path.join(config['output']['output_dir'], output)
+        if os.path.isfile(target):
+            os.remove(target)
+
+
+def rewrite_asset_urls(html, asset_outputs):
+    """
+    Rewrites relative references to assets in the given html to their (fingerprinted) output
+    Returns the rewritten html and the names of the referenced assets
+    """
+    referenced = []
+
+    def rewrite(match):
+        output = asset_outputs.get(match.group('path'))
+        if output is None:
+            return match.group(0)
+
+        referenced.append(match.group('path'))
+        return '{0}={1}{2}{3}{4}{1}'.format(match.group('attr'), match.group('quote'), match.group('prefix') or '',
+                                            output, match.group('suffix') or '')
+
+    return ASSET_REFERENCE.sub(rewrite, html), referenced
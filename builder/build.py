@@ -1,15 +1,23 @@
-import io
+import json
 import os
-import htmlmin
+import re
+import time
+from itertools import repeat
 from termcolor import colored
-from builder.template import render_template
+import tracing
+from builder.assets import rewrite_asset_urls
+from builder.template import render_template, get_env, get_template_hash, add_template_path, additional_templates
 try:
     from configuration import config
 except ImportError:
     pass
 from exceptions import BuildNoBuildFilesError
-from helpers import safe_create_dir
-from nlp import nlp_process
+from helpers import contents_get_hash, config_is_enabled, file_write_atomic
+from log import log
+from log.raw_entry import load_pages
+
+# Page references within the loaded html, i.e. <a href="page:ueber_uns#team">
+PAGE_REFERENCE = re.compile(r'(?P<attr>href|src)=(?P<quote>["\'])page:(?P<id>[^"\'#?]+)(?P<anchor>[#?][^"\']*)?(?P=quote)')
 
 
 class Builder:
@@ -25,10 +33,11 @@ class Builder:
     7.
     8. Test link and asset integrity (collect each link / asset (like img src, a hrefs etc) for 200 ok or errors
 
+    Page references (href="page:<id>") are resolved by resolve_references()
+    Sitemap and robots.txt are generated from the log by builder.sitemap
+
     Missing:
     - Menu / nav generation
-    - Sitemap generation
-    - robots.txt generation
     - Template partials (header, footer, etc)
     """
     def __init__(self, build_files):
@@ -37,64 +46,366 @@ class Builder:
         self.files = build_files
         self.contents = {}
         self.nav_entries = []
+        self.tfidf_index = None
+        self.tfidf_pending = {}
+        self.stats = {'written': 0, 'unchanged': 0, 'cache_hits': 0, 'text_processed': 0, 'text_unchanged': 0,
+                      'tfidf_updated': 0}
+        self.worker_timings = {}
 
     def prepare(self):
         """
         Takes all [meta] and [page] entries from the log-convert process (changed_files)
-        and uses a suitable loader from /loader for [meta] and [page] to load into a dict (meta) and html (page)
+        and filters them down to the published pages to be built
+        The pages are loaded into html batch by batch (see batches())
         """
         # Filter out all entries that are not in published state (i.e. draft)
-        self.contents = {k: v for k, v in self.files.items() if v['meta']['loaded']['status'] == 'published'}
+        # The status is taken from the nav summary in the log, so unchanged pairs aren't read here
+        self.contents = {k: v for k, v in self.files.items() if log.find_nav_summary(k, v)['status'] == 'published'}
+
+        # Drafts won't be rendered, so their pages never need to be converted
+        for entry_pair in self.files:
+            if entry_pair not in self.contents:
+                self.files[entry_pair].release()
 
         print('Preparation finished')
 
-    def process_text_auto(self):
+    def batches(self, batch_size=1000, workers=1):
+        """
+        Yields the names of the pages to be built in batches of batch_size
+        Each batch is loaded by a suitable loader from /loader right before it is yielded (with workers > 1 by a
+        process pool) and its page bodies are released once the batch has been processed (built),
+        so only a single batch of page bodies is resident at a time
+        """
+        names = list(self.contents)
+        for start in range(0, len(names), batch_size):
+            pages = names[start:start + batch_size]
+            with tracing.span('load_pages', pages=len(pages)):
+                load_pages([self.contents[name] for name in pages], workers)
+            yield pages
+
+            for name in pages:
+                self.contents[name].release(page=True)
+
+    def process_text_auto(self, all_files=None, workers=1, pages=None):
         """
         Automatically process the page's text
         This method can:
             - Extract keywords by enabling the extract_keywords option
             - Generate a summary by enabling the summary option
+        Results are stored in the log along with the hash of the processed html and options,
+        so only pages whose content has changed are processed again
+        With keyword_engine: 'tfidf' keywords are scored against all published pages in all_files (see tfidf)
+        Processes the given (loaded) pages or all pages to be built
+        The nlp module (and its heavy dependencies) is only imported if one of the options is enabled
+        """
+        extract_keywords = config_is_enabled(config['processing'].get('keyword_extraction'))
+        summarize = config_is_enabled(config['processing'].get('summary_generation'))
+        pages = list(self.contents) if pages is None else pages
+        if not (extract_keywords or summarize) or not pages:
+            return
+
+        from nlp import nlp_options, nlp_process_pages
+        options = nlp_options(extract_keywords=extract_keywords, summarize=summarize)
+        if extract_keywords and options['keyword_engine'] == 'tfidf':
+            self._extract_keywords_tfidf(all_files if all_files is not None else self.files, options, pages, workers)
+            options = nlp_options(extract_keywords=False, summarize=summarize)
+            if not summarize:
+                return
+
+        pending = []
+        for entry_pair in pages:
+            f_entry = log.find(name=entry_pair)
+            hash_nlp = contents_get_hash(json.dumps([options, self.contents[entry_pair]['page']['loaded']]).encode('utf-8'))
+            if f_entry and f_entry.hash_nlp != hash_nlp:
+                pending.append((f_entry, hash_nlp))
+
+        results = nlp_process_pages([self.contents[f_entry.file]['page']['loaded'] for f_entry, _ in pending],
+                                    options, workers=workers)
+        for (f_entry, hash_nlp), (keywords, summary) in zip(pending, results):
+            if options['extract_keywords']:
+                f_entry.keywords = keywords
+            f_entry.summary = summary
+            f_entry.hash_nlp = hash_nlp
+
+        self.stats['text_processed'] += len(pending)
+        self.stats['text_unchanged'] += len(pages) - len(pending)
+
+    def _extract_keywords_tfidf(self, all_files, options, pages, workers=1):
+        """
+        Updates the TF-IDF index with the published pages of all_files that have changed since the last build
+        and sets the keywords of the given pages
+        Changed pages which are built are tokenized once their own batch is loaded, so they are read (and hooked)
+        only once. Keywords of earlier batches are thus scored against the rows of changed pages in later batches
+        as of the last build (or without them on a cold build)
+        """
+        from nlp import nlp_tokenize_pages
+        if self.tfidf_index is None:
+            self._update_tfidf_index(all_files, options, workers)
+
+        names = [p for p in pages if p in self.tfidf_pending]
+        tokens = nlp_tokenize_pages([self.contents[entry_pair]['page']['loaded'] for entry_pair in names], options, workers)
+        for entry_pair, page_tokens in zip(names, tokens):
+            self.tfidf_index.set_page(entry_pair, self.tfidf_pending.pop(entry_pair), page_tokens)
+        if names and not self.tfidf_pending:
+            self._save_tfidf_index()
+
+        keywords = self.tfidf_index.top_terms([p for p in pages if p in self.tfidf_index.rows], options['keyword_count'])
+        for entry_pair, page_keywords in keywords.items():
+            f_entry = log.find(name=entry_pair)
+            if f_entry:
+                f_entry.keywords = page_keywords
+
+    def _update_tfidf_index(self, all_files, options, workers=1):
+        """
+        Loads the TF-IDF index, drops the rows of pages which aren't published anymore and tokenizes the changed
+        pages which aren't built (i.e. after a forced rebuild of a single page), changed pages to be built
+        are remembered in tfidf_pending
+        """
+        from nlp import nlp_tokenize_pages
+        from tfidf import get_index
+        index = get_index(os.path.join(config['log']['output_dir'], 'tfidf.npz'))
+
+        tokenizer = contents_get_hash(json.dumps([options['clear_html'], options['language'],
+                                                  options['min_word_length']]).encode('utf-8'))
+        keys = {entry_pair: '{0}:{1}'.format(tokenizer, all_files[entry_pair]['page'].get('hash'))
+                for entry_pair in all_files
+                if log.find_nav_summary(entry_pair, all_files[entry_pair])['status'] == 'published'}
+        stale = index.sync(keys)
+        self.tfidf_pending = {entry_pair: keys[entry_pair] for entry_pair in stale if entry_pair in self.contents}
+        self.stats['tfidf_updated'] = len(stale)
+
+        # Tokenize in batches (loaded at once, so plugins get whole batches as well)
+        unbuilt = [entry_pair for entry_pair in stale if entry_pair not in self.contents]
+        batch_size = config['processing'].get('batch_size', 1000)
+        for start in range(0, len(unbuilt), batch_size):
+            names = unbuilt[start:start + batch_size]
+            load_pages([all_files[entry_pair] for entry_pair in names], workers)
+            tokens = nlp_tokenize_pages([all_files[entry_pair]['page']['loaded'] for entry_pair in names], options, workers)
+            for entry_pair, page_tokens in zip(names, tokens):
+                index.set_page(entry_pair, keys[entry_pair], page_tokens)
+                all_files[entry_pair].release(page=True)
+
+        self.tfidf_index = index
+        if not self.tfidf_pending:
+            self._save_tfidf_index()
+
+    def _save_tfidf_index(self):
+        self.tfidf_index.save()
+        print(colored('TF-IDF keywords', 'grey'), '-> {0} pages indexed ({1} updated), {2} terms'.format(
+            len(self.tfidf_index.rows), self.stats['tfidf_updated'], len(self.tfidf_index.terms)))
+
+    def resolve_references(self, all_files, use_absolute_links=True, pages=None):
+        """
+        Rewrites page references (i.e. <a href="page:ueber_uns">) in the loaded html of the given pages
+        (or all pages to be built) to the final url of the referenced page. The id is either the file name or the uid of the referenced page.
+        The references of each resolved page are recorded in the log, so pages referencing a page whose title or
+        slug has changed can be rebuilt without rebuilding the whole site
         """
-        for entry_pair in self.contents:
-            keywords, summary = nlp_process(self.contents[entry_pair]['page'])
-            print(keywords, summary)
+        for entry_pair in list(self.contents) if pages is None else pages:
+            page_obj = self.contents[entry_pair]
+            targets = []
+
+            def resolve(match):
+                target_entry = log.find(name=match.group('id')) or log.find(name=None, uid=match.group('id'))
+                if not target_entry or target_entry.file not in all_files:
+                    print(colored('Could not resolve page reference', 'red'), match.group('id'), 'in', entry_pair)
+                    return match.group(0)
+
+                targets.append(target_entry.uid)
+                url = _page_url(log.find_nav_summary(target_entry.file, all_files[target_entry.file])['slug'], use_absolute_links)
+                return '{0}={1}{2}{3}{1}'.format(match.group('attr'), match.group('quote'), url, match.group('anchor') or '')
+
+            page_obj['page']['loaded'] = PAGE_REFERENCE.sub(resolve, page_obj['page']['loaded'])
+
+            f_entry = log.find(name=entry_pair)
+            if f_entry:
+                log.set_references(f_entry, targets)
 
     def build_nav(self, all_files, use_absolute_links=True):
         """
         Generates an internal representation of the website's navigation of all passed files
         Call this method before build() to include a nav within the website
+        The nav is built from the nav summaries in the log, so unchanged files don't need to be loaded
         """
         print(colored('Building navigation', 'grey'))
 
         self.nav_entries = []
         for entry_pair in all_files:
-            page_obj = all_files[entry_pair]
+            nav_summary = log.find_nav_summary(entry_pair, all_files[entry_pair])
 
             self.nav_entries.append({
-                'title': page_obj['meta']['loaded']['title'],
-                'url': '{0}{1}.{2}'.format('/' if use_absolute_links else '', page_obj['meta']['loaded']['slug'], config['output']['file_format'])
+                'title': nav_summary['title'],
+                'url': _page_url(nav_summary['slug'], use_absolute_links)
             })
 
-    def build(self, minify_html=True):
+    def build(self, minify_html=True, workers=1, render_cache=None, pages=None, asset_outputs=None):
         """
         Render output using the Jinja template engine
+        Output files whose hash matches the output hash stored in the log are not written again,
+        changed output files are replaced atomically
+        With a render_cache (see builder.cache), pages whose inputs have been rendered before are taken from the cache
+        With workers > 1 the pages are sharded across worker processes, each holding its own Jinja env and nav
+        With asset_outputs (asset name -> output, see log.find_asset_outputs), asset references are rewritten to
+        the outputs and always recorded as references of the page, even if the outputs are not fingerprinted,
+        so the page is rebuilt once the url of an asset changes (i.e. after enabling assets.fingerprint)
+        Builds the given (loaded) pages or all pages, the counts are summed up by print_build_summary()
         """
-        for page in self.contents:
-            page_obj = self.contents[page]
+        nav_fingerprint = contents_get_hash(json.dumps(self.nav_entries, sort_keys=True).encode('utf-8'))
+        pages = [_page_payload(page, self.contents[page]) for page in (list(self.contents) if pages is None else pages)]
+        if render_cache:
+            for page in pages:
+                page['cache_key'] = render_cache.key(page['template'], get_template_hash(page['template']),
+                                                     page['page'], nav_fingerprint, minify_html)
+        results = []
 
-            output_html = render_template(page_obj['meta']['loaded']['template'], page={
-                'title': page_obj['meta']['loaded']['title'],
-                'content': page_obj['page']['loaded'],
-                'website_name': config['project']['name']
-            }, nav=self.nav_entries)
+        if workers <= 1 or len(pages) < 2:
+            for page in pages:
+                results.append(_build_page(page, self.nav_entries, minify_html, render_cache, asset_outputs))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            shards = [pages[i::workers] for i in range(workers)]
+            pages = [page for shard in shards for page in shard]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_build_worker,
+                                     initargs=(self.nav_entries, additional_templates, asset_outputs, tracing.enabled)) as pool:
+                shard_results = pool.map(_build_shard, shards, repeat(minify_html), repeat(render_cache))
+                for shard, (pid, elapsed, shard_results, events) in zip(shards, shard_results):
+                    results.extend(shard_results)
+                    tracing.add_events(events)
+                    built, total = self.worker_timings.get(pid, (0, 0.0))
+                    self.worker_timings[pid] = (built + len(shard), total + elapsed)
 
-            print(colored('Generated output file', 'green'), page_obj['meta']['loaded']['slug'])
+        for page, (output_hash, is_written, cache_hit, assets) in zip(pages, results):
+            if is_written:
+                self.stats['written'] += 1
+                print(colored('Generated output file', 'green'), page['slug'])
+            else:
+                self.stats['unchanged'] += 1
+                print(colored('Skipping unchanged output file', 'magenta'), page['slug'])
+            self.stats['cache_hits'] += cache_hit
 
-            output_path = os.path.join(config['output']['output_dir'], '{0}.{1}'.format(page_obj['meta']['loaded']['slug'], config['output']['file_format']))
+            f_entry = log.find(name=page['name'])
+            if f_entry:
+                f_entry.hash_output = output_hash
+                # Remember the template closure, so template changes rebuild only the pages using them
+                f_entry.template = page['template']
+                f_entry.hash_template = get_template_hash(page['template'])
+                if assets:
+                    log.set_references(f_entry, f_entry.references + [log.find(name=a).uid for a in set(assets)])
 
-            if minify_html:
+    def print_build_summary(self, render_cache=None):
+        """
+        Prints the counts of all build() calls and evicts the render cache
+        """
+        for pid, (built, elapsed) in self.worker_timings.items():
+            print(colored('Build worker', 'grey'), pid, '-> {0} pages in {1:.3f}s'.format(built, elapsed))
+
+        if self.stats['text_processed'] or self.stats['text_unchanged']:
+            print(colored('Text processing', 'grey'), '-> {0} processed, {1} unchanged'.format(
+                self.stats['text_processed'], self.stats['text_unchanged']))
+
+        print(colored('Output files', 'grey'), '-> {0} written, {1} unchanged'.format(
+            self.stats['written'], self.stats['unchanged']))
+
+        if render_cache:
+            built = self.stats['written'] + self.stats['unchanged']
+            evicted = render_cache.evict()
+            print(colored('Render cache', 'grey'), '-> {0} hits, {1} misses, {2} evicted'.format(
+                self.stats['cache_hits'], built - self.stats['cache_hits'], evicted))
+
+
+def _page_url(slug, use_absolute_links=True):
+    return '{0}{1}.{2}'.format('/' if use_absolute_links else '', slug, config['output']['file_format'])
+
+
+# Per process state of the build workers, set once by _init_build_worker()
+worker_nav = []
+worker_asset_outputs = None
+
+
+def _init_build_worker(nav_entries, template_paths, asset_outputs=None, trace=False):
+    """
+    Initializes a build worker process with the nav, the asset outputs and a warmed up Jinja env
+    With trace, the worker records spans of its pages (see tracing)
+    """
+    global worker_nav, worker_asset_outputs
+    worker_nav = nav_entries
+    worker_asset_outputs = asset_outputs
+    tracing.enable(trace)
+    # Forked workers inherit the spans recorded so far by the main process
+    tracing.pop_events()
+    for path in template_paths:
+        if path not in additional_templates:
+            add_template_path(path)
+    get_env()
+
+
+def _page_payload(name, page_obj):
+    """
+    Returns everything needed to render a page, in a form that can be shipped to build workers
+    """
+    f_entry = log.find(name=name)
+    return {
+        'name': name,
+        'hash_output': f_entry.hash_output if f_entry else None,
+        'template': page_obj['meta']['loaded']['template'],
+        'slug': page_obj['meta']['loaded']['slug'],
+        'page': {
+            'title': page_obj['meta']['loaded']['title'],
+            'content': page_obj['page']['loaded'],
+            'keywords': f_entry.keywords if f_entry else [],
+            'summary': f_entry.summary if f_entry else '',
+            'website_name': config['project']['name']
+        }
+    }
+
+
+def _build_page(page, nav, minify_html, render_cache=None, asset_outputs=None):
+    """
+    Renders and minifies a single page (or takes it from the render cache) and rewrites its asset references,
+    the output is only written if its hash differs from the logged one
+    Returns the output hash, whether the file has been written, whether the render cache was hit
+    and the names of the referenced assets
+    """
+    with tracing.span('build_page', 'page', page=page['name']):
+        return _render_page(page, nav, minify_html, render_cache, asset_outputs)
+
+
+def _render_page(page, nav, minify_html, render_cache=None, asset_outputs=None):
+    output_html = render_cache.get(page['cache_key']) if render_cache else None
+    cache_hit = output_html is not None
+
+    if not cache_hit:
+        with tracing.span('render', 'page_step', page=page['name']):
+            output_html = render_template(page['template'], page=page['page'], nav=nav)
+
+        if minify_html:
+            import htmlmin
+            with tracing.span('minify', 'page_step', page=page['name']):
                 output_html = htmlmin.minify(output_html, remove_comments=True, remove_empty_space=True)
 
-            safe_create_dir(output_path)
-            with io.open(output_path, 'w+', encoding='utf-8') as output_file:
-                output_file.write(output_html)
+        if render_cache:
+            render_cache.put(page['cache_key'], output_html)
+
+    assets = []
+    if asset_outputs:
+        output_html, assets = rewrite_asset_urls(output_html, asset_outputs)
+
+    output_path = os.path.join(config['output']['output_dir'], '{0}.{1}'.format(page['slug'], config['output']['file_format']))
+
+    output_hash = contents_get_hash(output_html.encode('utf-8'), config['log'].get('hash_algorithm', 'md5'))
+    if output_hash == page['hash_output'] and os.path.isfile(output_path):
+        return output_hash, False, cache_hit, assets
+
+    with tracing.span('write', 'page_step', page=page['name']):
+        file_write_atomic(output_path, output_html)
+    return output_hash, True, cache_hit, assets
+
+
+def _build_shard(pages, minify_html, render_cache=None):
+    """
+    Builds a shard of pages inside a build worker, returns the worker's pid, the elapsed time, the page results
+    and the spans recorded meanwhile
+    """
+    start = time.time()
+    results = [_build_page(page, worker_nav, minify_html, render_cache, worker_asset_outputs) for page in pages]
+    return os.getpid(), time.time() - start, results, tracing.pop_events()
@@ -0,0 +1,30 @@
+import json
+from helpers import DiskCache, contents_get_hash
+
+
+class RenderCache(DiskCache):
+    """
+    Content-addressed cache of rendered (and minified) page html
+    Keys are hashes over everything that goes into a rendered page (see key()), so a page whose inputs match
+    any earlier build doesn't need to be rendered again.
+    """
+    extension = '.html'
+
+    def __init__(self, path, max_size=256 * 1024 * 1024, salt=None):
+        super().__init__(path, max_size)
+        self.salt = salt
+
+    def key(self, *parts):
+        """
+        Returns the cache key for the given inputs (must be JSON-able)
+        """
+        return contents_get_hash(json.dumps([self.salt, parts], sort_keys=True).encode('utf-8'), 'sha256')
+
+    def _dumps(self, html):
+        return html.encode('utf-8')
+
+    def _loads(self, data):
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
@@ -0,0 +1,127 @@
+import json
+import os
+from termcolor import colored
+from builder.assets import publish_file
+from helpers import contents_get_hash, dir_evict_lru, file_get_hash, file_get_stat, safe_create_dir
+from log import log
+
+
+def _run_transform(transform, source, target, params):
+    """
+    Runs a single transform into a temporary file next to target and moves it into place
+    With workers > 1, run() maps it over the missing derivatives on a process pool
+    """
+    safe_create_dir(target)
+    tmp_path = os.path.join(os.path.dirname(target), '.{0}.tmp{1}'.format(os.path.basename(target), os.path.splitext(target)[1]))
+    try:
+        transform(source, tmp_path, **params)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class DerivativeCache:
+    """
+    Cache of files derived from assets by plugins (i.e. thumbnails or resized images)
+
+    Plugins request a derivative by its source file, a transform and the transform's parameters (see request()).
+    Keys are hashes over the source's content hash, the transform, its parameters and the requesting plugin's version,
+    so a derivative is only generated again if any of them changes. Requests are collected during the build and
+    generated together by run(), missing derivatives on a process pool. Derivatives are kept in the store dir
+    and published to the output dir by hard link (see builder.assets), the cache is capped to max_size bytes.
+    """
+    def __init__(self, path, output_dir, input_dir=None, max_size=1024 * 1024 * 1024, link='hardlink'):
+        self.path = path
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.max_size = max_size
+        self.link = link
+        self.pending = {}
+        self.source_hashes = {}
+        self.reused = 0
+        self.regenerated = 0
+        self.published = 0
+
+    def _source_hash(self, source):
+        """
+        Returns the content hash of a source, logged assets (see log.convert_assets) with an unchanged stat tuple
+        and sources already hashed with the same stat tuple aren't hashed again
+        """
+        stat = file_get_stat(source)
+        if source in self.source_hashes and self.source_hashes[source][0] == stat:
+            return self.source_hashes[source][1]
+
+        f_entry = log.find(name=os.path.relpath(source, self.input_dir).replace(os.sep, '/')) if self.input_dir else None
+        if f_entry and f_entry.kind == 'asset' and f_entry.hash_file and f_entry.stat_file == stat:
+            source_hash = f_entry.hash_file
+        else:
+            source_hash = file_get_hash(source)
+        self.source_hashes[source] = (stat, source_hash)
+        return source_hash
+
+    def request(self, source, transform, params, output, salt=None):
+        """
+        Requests the derivative of source, made by transform(source, target, **params), to be published as output
+        (relative to the output dir). transform must be a module level function, params must be JSON-able
+        Returns output, the derivative itself is generated (or taken from the cache) by run()
+        """
+        key = contents_get_hash(json.dumps([self._source_hash(source), transform.__module__, transform.__qualname__,
+                                            params, salt], sort_keys=True).encode('utf-8'), 'sha256')
+        self.pending[output] = {
+            'source': source,
+            'transform': transform,
+            'params': params,
+            'cached': os.path.join(self.path, key[:2], key + os.path.splitext(output)[1])
+        }
+        return output
+
+    def run(self, workers=1):
+        """
+        Generates the missing derivatives of all requests and publishes all of them to the output dir
+        """
+        missing = {}
+        for derivative in self.pending.values():
+            if os.path.isfile(derivative['cached']):
+                # Refresh the mtime, so recently used derivatives are evicted last
+                os.utime(derivative['cached'])
+            else:
+                # Equal requests (i.e. the same thumbnail on several pages) are generated once
+                missing[derivative['cached']] = derivative
+        missing = list(missing.values())
+
+        if workers > 1 and len(missing) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(workers, len(missing))) as pool:
+                list(pool.map(_run_transform, [d['transform'] for d in missing], [d['source'] for d in missing],
+                              [d['cached'] for d in missing], [d['params'] for d in missing]))
+        else:
+            for derivative in missing:
+                _run_transform(derivative['transform'], derivative['source'], derivative['cached'], derivative['params'])
+
+        published = 0
+        for output, derivative in self.pending.items():
+            target = os.path.join(self.output_dir, output)
+            if os.path.exists(target) and os.path.samefile(derivative['cached'], target):
+                continue
+            publish_file(derivative['cached'], target, self.link)
+            published += 1
+
+        self.regenerated += len(missing)
+        self.reused += len(set(d['cached'] for d in self.pending.values())) - len(missing)
+        self.published += published
+        self.pending = {}
+        return published
+
+    def evict(self):
+        """
+        Removes the least recently used derivatives until the cache fits into max_size
+        Returns the number of removed derivatives
+        """
+        return dir_evict_lru(self.path, self.max_size)
+
+    def print_summary(self):
+        if self.reused or self.regenerated:
+            print(colored('Derivatives', 'grey'), '-> {0} reused, {1} regenerated, {2} published, {3} evicted'.format(
+                self.reused, self.regenerated, self.published, self.evict()))
+        self.reused = self.regenerated = self.published = 0
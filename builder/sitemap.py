@@ -0,0 +1,143 @@
+import gzip
+import io
+import json
+import math
+import os
+from datetime import datetime
+from xml.sax.saxutils import escape
+from termcolor import colored
+try:
+    from configuration import config
+except ImportError:
+    pass
+from helpers import config_is_enabled, contents_get_hash, file_write_atomic
+from log import log
+
+SITEMAP_NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def _lastmod(last_modified):
+    """
+    Returns the W3C date of a log entry's last_modified (a datetime or its str() as loaded from the log store)
+    """
+    if not last_modified:
+        return None
+    if not isinstance(last_modified, datetime):
+        try:
+            last_modified = datetime.fromisoformat(str(last_modified))
+        except ValueError:
+            return None
+    return last_modified.date().isoformat()
+
+
+def _shard_of(name, shards):
+    """
+    Pages are assigned to shards by the hash of their name, so adding or removing a page only changes its own shard
+    """
+    return int(contents_get_hash(name.encode('utf-8'))[:8], 16) % shards
+
+
+def _urlset(urls):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<urlset xmlns="{0}">'.format(SITEMAP_NAMESPACE)]
+    for loc, lastmod in urls:
+        lines.append('<url><loc>{0}</loc>{1}</url>'.format(
+            escape(loc), '<lastmod>{0}</lastmod>'.format(lastmod) if lastmod else ''))
+    lines.append('</urlset>')
+    return '\n'.join(lines) + '\n'
+
+
+def _sitemapindex(sitemaps):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<sitemapindex xmlns="{0}">'.format(SITEMAP_NAMESPACE)]
+    for loc, lastmod in sitemaps:
+        lines.append('<sitemap><loc>{0}</loc>{1}</sitemap>'.format(
+            escape(loc), '<lastmod>{0}</lastmod>'.format(lastmod) if lastmod else ''))
+    lines.append('</sitemapindex>')
+    return '\n'.join(lines) + '\n'
+
+
+def _write_if_changed(file_name, contents, manifest, compress=False):
+    """
+    Writes contents to the output dir unless the manifest (file name -> contents hash) says it's unchanged
+    Returns whether the file has been written
+    """
+    output_path = os.path.join(config['output']['output_dir'], file_name)
+    contents_hash = contents_get_hash(contents.encode('utf-8'))
+    if manifest.get(file_name) == contents_hash and os.path.isfile(output_path):
+        return False
+
+    # mtime=0 keeps the gzipped output reproducible
+    file_write_atomic(output_path, gzip.compress(contents.encode('utf-8'), mtime=0) if compress else contents)
+    manifest[file_name] = contents_hash
+    return True
+
+
+def build_sitemap(all_files):
+    """
+    Generates sitemap.xml (a sitemap index) with its child sitemaps and robots.txt for all published pages
+
+    The urls and lastmod dates come from the nav summaries and the last_modified dates in the log,
+    so no page needs to be loaded. Pages are spread over as many child sitemaps as needed to stay within
+    shard_size urls (50000 by the protocol), optionally gzipped. Only child sitemaps whose pages have been added,
+    removed or modified are written again, the hashes of the written files are kept in <log dir>/sitemap.json
+    """
+    sitemap_config = config.get('sitemap', {})
+    base_url = sitemap_config.get('base_url', '').rstrip('/')
+    if not base_url:
+        print(colored('No sitemap.base_url given, skipping sitemap and robots.txt', 'yellow'))
+        return
+
+    manifest_path = os.path.join(config['log']['output_dir'], 'sitemap.json')
+    try:
+        with io.open(manifest_path, 'r', encoding='utf-8') as manifest_open:
+            manifest = json.load(manifest_open)
+    except (OSError, ValueError):
+        manifest = {}
+
+    urls = []
+    for entry_pair in sorted(all_files):
+        nav_summary = log.find_nav_summary(entry_pair, all_files[entry_pair])
+        if nav_summary['status'] != 'published':
+            continue
+        f_entry = log.find(name=entry_pair)
+        urls.append((entry_pair, '{0}/{1}.{2}'.format(base_url, nav_summary['slug'], config['output']['file_format']),
+                     _lastmod(f_entry.last_modified) if f_entry else None))
+
+    # Grow the number of shards until none of them exceeds the limit
+    shard_size = sitemap_config.get('shard_size', 50000)
+    shards = max(1, math.ceil(len(urls) / shard_size))
+    while True:
+        shard_urls = [[] for _ in range(shards)]
+        for name, loc, lastmod in urls:
+            shard_urls[_shard_of(name, shards)].append((loc, lastmod))
+        if max(len(s) for s in shard_urls) <= shard_size:
+            break
+        shards += 1
+
+    compress = config_is_enabled(sitemap_config.get('gzip', False))
+    extension = 'xml.gz' if compress else 'xml'
+    written = 0
+    sitemaps = []
+    for i, shard in enumerate(shard_urls):
+        file_name = 'sitemap-{0}.{1}'.format(i + 1, extension)
+        written += _write_if_changed(file_name, _urlset(shard), manifest, compress)
+        sitemaps.append(('{0}/{1}'.format(base_url, file_name), max((m for _, m in shard if m), default=None)))
+
+    # Child sitemaps left over from a larger sitemap or another compression setting
+    current = set('sitemap-{0}.{1}'.format(i + 1, extension) for i in range(shards))
+    for file_name in [f for f in manifest if f.startswith('sitemap-') and f not in current]:
+        output_path = os.path.join(config['output']['output_dir'], file_name)
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+        del manifest[file_name]
+
+    written += _write_if_changed('sitemap.xml', _sitemapindex(sitemaps), manifest)
+
+    if config_is_enabled(sitemap_config.get('robots', True)):
+        robots = ['User-agent: *']
+        robots += ['Disallow: {0}'.format(path) for path in sitemap_config.get('robots_disallow', [])] or ['Disallow:']
+        robots.append('Sitemap: {0}/sitemap.xml'.format(base_url))
+        written += _write_if_changed('robots.txt', '\n'.join(robots) + '\n', manifest)
+
+    if written:
+        file_write_atomic(manifest_path, json.dumps(manifest, sort_keys=True))
+    print(colored('Sitemap', 'grey'), '-> {0} urls in {1} sitemaps, {2} files written'.format(len(urls), shards, written))
@@ -1,11 +1,32 @@
-from jinja2 import Environment, FileSystemLoader, select_autoescape, BaseLoader
+import os
+from functools import lru_cache
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape, BaseLoader, TemplateNotFound, \
+    TemplateError, meta
+from termcolor import colored
+from helpers import contents_get_hash
 try:
     from configuration import config
 except ImportError:
     pass
 
+# File extensions of the templates to precompile, other files in the template paths (images, etc) are skipped
+TEMPLATE_EXTENSIONS = ['html', 'htm', 'xml', 'txt', 'j2', 'jinja', 'jinja2']
+
 additional_templates = []
 env = None
+string_env = Environment(loader=BaseLoader())
+# Per template name: hash of its source and the templates it references directly (see get_template_hash)
+template_sources = {}
+
+
+def _get_bytecode_cache():
+    """
+    Compiled templates are cached on disk in the store directory across che runs
+    Jinja validates each cached template against the checksum of its current source
+    """
+    cache_dir = os.path.join(config['log']['output_dir'], 'templates')
+    os.makedirs(cache_dir, exist_ok=True)
+    return FileSystemBytecodeCache(cache_dir)
 
 
 def get_env():
@@ -13,7 +34,8 @@ def get_env():
     if env is None:
         env = Environment(
             loader=FileSystemLoader(list([config['templates']['path']] + additional_templates)),
-            autoescape=select_autoescape(['html', 'xml'])
+            autoescape=select_autoescape(['html', 'xml']),
+            bytecode_cache=_get_bytecode_cache()
         )
     return env
 
@@ -22,12 +44,76 @@ def add_template_path(path):
     additional_templates.append(path)
 
 
+def _get_template_source(template):
+    """
+    Returns the source hash and the directly referenced templates (extends, include, import) of a template,
+    found through the Jinja AST. Dynamic references (i.e. {% include some_var %}) can't be tracked
+    """
+    if template not in template_sources:
+        source, _, _ = get_env().loader.get_source(get_env(), template)
+        references = [r for r in meta.find_referenced_templates(get_env().parse(source)) if r is not None]
+        template_sources[template] = (contents_get_hash(source.encode('utf-8')), references)
+    return template_sources[template]
+
+
+def get_template_closure(template):
+    """
+    Returns the names of the template and all templates it (transitively) extends, includes or imports
+    """
+    closure = set()
+    pending = [template]
+    while pending:
+        name = pending.pop()
+        if name in closure:
+            continue
+        closure.add(name)
+        pending.extend(_get_template_source(name)[1])
+    return sorted(closure)
+
+
+def get_template_hash(template):
+    """
+    Returns a hash over the sources of the template's closure, or None if a template can't be found
+    """
+    try:
+        closure = get_template_closure(template)
+        hashes = ['{0}:{1}'.format(name, _get_template_source(name)[0]) for name in closure]
+    except TemplateNotFound:
+        return None
+    return contents_get_hash('\n'.join(hashes).encode('utf-8'))
+
+
+def clear_template_sources():
+    """
+    Forget the template hashes of this run, i.e. to detect template changes within a long running process
+    """
+    template_sources.clear()
+
+
 def _load_template(template):
     return get_env().get_template(template)
 
 
+@lru_cache(maxsize=128)
 def _load_template_from_string(template_str):
-    return Environment(loader=BaseLoader()).from_string(template_str)
+    return string_env.from_string(template_str)
+
+
+def warm_templates():
+    """
+    Compiles all templates of all template paths into the bytecode cache
+    Templates which can't be compiled are reported and skipped, they fail again once a page is rendered with them
+    Returns the names of the compiled templates
+    """
+    names = []
+    for name in get_env().list_templates(extensions=TEMPLATE_EXTENSIONS):
+        try:
+            _load_template(name)
+        except (TemplateError, UnicodeDecodeError) as e:
+            print(colored('Could not compile template', 'red'), name, e)
+            continue
+        names.append(name)
+    return names
 
 
 def render_template(template, **kwargs):
@@ -36,7 +122,7 @@ def render_template(template, **kwargs):
     """
     if 'page' not in kwargs:
         kwargs['page'] = None
-    if 'title' not in kwargs:
+    if 'nav' not in kwargs:
         kwargs['nav'] = []
     return _load_template(template).render(kwargs)
 
@@ -2,48 +2,184 @@ import argparse
 import os
 import time
 from termcolor import colored
-import cli
+from builder.assets import publish_assets, remove_asset_outputs
 from builder.build import Builder
+from builder.derivatives import DerivativeCache
+from builder.sitemap import build_sitemap
+from builder.cache import RenderCache
+from builder.template import warm_templates, clear_template_sources, additional_templates
 from exceptions import ConfigNotFoundError
+from helpers import config_is_enabled, get_peak_memory
 
 try:
     from configuration import config
     config_found = True
 except ImportError:
     config_found = False
+import tracing
 from hooks import add_subscriber, HOOK_BEFORE_LOAD, HOOK_AFTER_LOAD
-from log import log
-from plugin import PluginHandler
+from log import log, raw_entry
+from plugin import PluginHandler, HookCache
+
+# Modules only needed by single commands (cli, watch, server) are imported by those commands to keep startup fast
 
 # Create all supported command line options and commands
 argparser = argparse.ArgumentParser()
 subparser = argparser.add_subparsers(dest='command')
 argparser.add_argument('--force_rebuild', help='Force rebuild of all files, despite of any changes', action='store_true')
+argparser.add_argument('--verify', help='Read and hash all files, even if their stat information is unchanged', action='store_true')
+argparser.add_argument('--jobs', help='Number of workers for loading and converting files', type=int)
+argparser.add_argument('--trace', help='Write the spans of the build to this file (Chrome trace format)')
+argparser.add_argument('--profile', help='Print the time of each build phase and the N slowest pages and plugins',
+                       type=int, nargs='?', const=10)
 parser_new = subparser.add_parser('new')
 parser_init = subparser.add_parser('init')
 parser_activate = subparser.add_parser('activate')
 parser_deactivate = subparser.add_parser('deactivate')
+parser_templates = subparser.add_parser('templates')
+parser_watch = subparser.add_parser('watch')
+parser_serve = subparser.add_parser('serve')
 parser_new.add_argument('page', nargs='+', help='Generate a new page with the specified name')
 parser_activate.add_argument('page', nargs='+', help='Activate specified page')
 parser_deactivate.add_argument('page', nargs='+', help='Deactivate specified page')
+parser_serve.add_argument('--host', help='Host of the local build service')
+parser_serve.add_argument('--port', help='Port of the local build service', type=int)
+parser_templates.add_argument('action', choices=['warm'], help='warm: Precompile all templates into the bytecode cache')
 
 installed_plugins = []
+plugin_handler = None
+
+
+def build(files, ok, force_rebuild=False, workers=1, verify=False):
+    """
+    Runs the (incremental) build for the given raw entries, as returned by log.load_raw_entries()
+    With verify (or force_rebuild) all assets are hashed again, regardless of their stat information
+    """
+    # Assets are published before the pages, so pages never reference a missing asset
+    asset_config = config.get('assets', {})
+    fingerprint = config_is_enabled(asset_config.get('fingerprint', False))
+    with tracing.span('assets'):
+        found_assets = log.load_assets(config['input']['input_dir'], verify=force_rebuild or verify)
+        changed_assets, stale_outputs, asset_url_changes = log.convert_assets(found_assets, fingerprint=fingerprint)
+        publish_assets(found_assets, changed_assets, link=asset_config.get('link', 'hardlink'))
+
+    with tracing.span('convert_raw_entries'):
+        changed_files, needs_rebuild_from_files = log.convert_raw_entries(files, asset_url_changes)
+
+    # this would return false for ok if any file is not a pair (= missing either a meta or a page file)
+    print('File integrity: ', colored('OK ', 'green') if ok else colored('Error!', 'red'))
+
+    # Force rebuild either by files or by command line option --force-rebuild
+    needs_rebuild = force_rebuild or needs_rebuild_from_files
+
+    builder = Builder(changed_files if not needs_rebuild else files)
+    with tracing.span('prepare'):
+        builder.prepare()
+
+    # The nav is needed for every page that is built, not only for complete rebuilds
+    if config['templates']['build_nav'] and builder.contents:
+        with tracing.span('build_nav'):
+            builder.build_nav(files, use_absolute_links=False)
+
+    render_cache = None
+    cache_config = config.get('cache', {})
+    if config_is_enabled(cache_config.get('render_cache', True)):
+        render_cache = RenderCache(os.path.join(config['log']['output_dir'], 'render_cache'),
+                                   max_size=cache_config.get('render_cache_max_size', 256 * 1024 * 1024),
+                                   salt=plugin_handler.get_versions() if plugin_handler else None)
+
+    # Load, process and render the pages batch by batch, so only one batch of page bodies is held in memory
+    for pages in builder.batches(config['processing'].get('batch_size', 1000), workers=workers):
+        with tracing.span('resolve_references'):
+            builder.resolve_references(files, use_absolute_links=False, pages=pages)
+        with tracing.span('process_text_auto'):
+            builder.process_text_auto(files, workers=workers, pages=pages)
+
+        # Render html to Jinja template
+        with tracing.span('build', pages=len(pages)):
+            builder.build(minify_html=config['output']['minify_html'], workers=workers, render_cache=render_cache,
+                          pages=pages, asset_outputs=log.find_asset_outputs())
+
+    builder.print_build_summary(render_cache)
+
+    sitemap_config = config.get('sitemap', {})
+    if config_is_enabled(sitemap_config.get('enabled', False)) and (
+            builder.contents or log.rebuild_reasons or not os.path.isfile(os.path.join(config['output']['output_dir'], 'sitemap.xml'))):
+        with tracing.span('sitemap'):
+            build_sitemap(files)
+    if plugin_handler:
+        with tracing.span('derivatives'):
+            plugin_handler.run_derivatives(workers)
+    remove_asset_outputs(stale_outputs)
+
+    log.print_rebuild_summary(builder.contents, forced=force_rebuild)
+
+    if raw_entry.parse_cache:
+        evicted = raw_entry.parse_cache.evict()
+        print(colored('Parse cache', 'grey'), '-> {0} hits, {1} misses, {2} evicted'.format(
+            raw_entry.parse_cache.hits, raw_entry.parse_cache.misses, evicted))
+        raw_entry.parse_cache.hits = raw_entry.parse_cache.misses = 0
+
+    hook_cache = plugin_handler.hook_cache if plugin_handler else None
+    if hook_cache and (hook_cache.hits or hook_cache.misses):
+        print(colored('Hook cache', 'grey'), '-> {0} hits, {1} misses, {2} evicted'.format(
+            hook_cache.hits, hook_cache.misses, hook_cache.evict()))
+        hook_cache.hits = hook_cache.misses = 0
+
+    # Update log file after the successful build
+    with tracing.span('log_write'):
+        log.write()
+
+    return list(builder.contents)
+
+
+def rebuild(workers=1):
+    """
+    Runs another incremental build within a long running process (watch, serve)
+    Log, plugins and Jinja env stay in memory, only the changed pairs are read again
+    """
+    clear_template_sources()
+    files, ok = log.load_raw_entries(os.path.join(config['input']['input_dir']), workers=workers)
+    try:
+        return build(files, ok, workers=workers)
+    except Exception:
+        # The log in memory already holds the new hashes of the pages that failed to build,
+        # restore it from the store, so they are built again on the next change
+        log.reload()
+        raise
 
 
 if __name__ == '__main__':
     # Read command line options
     args = argparser.parse_args()
     build_time_start = time.time()
+    tracing.enable(bool(args.trace or args.profile))
+    try:
+        workers = args.jobs or config['processing'].get('workers', 1)
+    except NameError:
+        workers = 1
 
     # Activate plugins and emit hooks
     try:
-        plugin_handler = PluginHandler(config['plugins']['path'])
-        plugin_handler.install_plugins()
+        cache_config = config.get('cache', {})
+        derivatives = DerivativeCache(
+            os.path.join(config['log']['output_dir'], 'derivatives'), config['output']['output_dir'],
+            input_dir=config['input']['input_dir'], max_size=cache_config.get('derivative_cache_max_size', 1024 * 1024 * 1024),
+            link=config.get('assets', {}).get('link', 'hardlink'))
+        hook_cache = None
+        if config_is_enabled(cache_config.get('hook_cache', True)):
+            hook_cache = HookCache(os.path.join(config['log']['output_dir'], 'hook_cache'),
+                                   max_size=cache_config.get('hook_cache_max_size', 256 * 1024 * 1024))
+        plugin_handler = PluginHandler(config['plugins']['path'], derivatives=derivatives, hook_cache=hook_cache)
+        with tracing.span('install_plugins'):
+            plugin_handler.install_plugins()
 
         add_subscriber(plugin_handler, HOOK_BEFORE_LOAD, HOOK_AFTER_LOAD)
 
         # Preload the files
-        files, ok = log.load_raw_entries(os.path.join(config['input']['input_dir']))
+        with tracing.span('load_raw_entries'):
+            files, ok = log.load_raw_entries(os.path.join(config['input']['input_dir']),
+                                             verify=args.force_rebuild or args.verify, workers=workers)
         if not ok:
             # print(colored('BUILD ERROR', 'red'), 'Build time: {0}'.format(time.time() - build_time_start))
             # exit()
@@ -55,9 +191,11 @@ if __name__ == '__main__':
 
     # CLI: Create file(s) or structures
     if args.command == 'init':
+        import cli
         cli.cli_init()
         exit()
     elif args.command == 'new':
+        import cli
         if args.page:
             try:
                 cli.cli_new_page(args.page[1])
@@ -65,6 +203,7 @@ if __name__ == '__main__':
                 print(colored('Failed to generate new page, please provide name!', 'red'))
         exit()
     elif args.command in ['activate', 'deactivate']:
+        import cli
         if args.page:
             try:
                 entry = files[args.page[0]]
@@ -74,26 +213,48 @@ if __name__ == '__main__':
             except KeyError:
                 print(colored('Could not activate / find page', 'red'), args.page[0])
         exit()
+    elif args.command == 'templates':
+        if args.action == 'warm':
+            warmed = warm_templates()
+            print(colored('Precompiled templates:', 'green'), len(warmed))
+        exit()
+    elif args.command == 'watch':
+        from watch import watch
+        build(files, ok, force_rebuild=args.force_rebuild, workers=workers, verify=args.verify)
+        print(colored('BUILD SUCCESSFUL', 'green', 'on_grey'), ' -> Build time: {0}'.format(time.time() - build_time_start))
 
-    changed_files, needs_rebuild_from_files = log.convert_raw_entries(files)
-
-    # this would return false for ok if any file is not a pair (= missing either a meta or a page file)
-    print('File integrity: ', colored('OK ', 'green') if ok else colored('Error!', 'red'))
-
-    # Force rebuild either by files or by command line option --force-rebuild
-    needs_rebuild = args.force_rebuild or needs_rebuild_from_files
-
-    builder = Builder(changed_files if not needs_rebuild else files)
-    builder.prepare()
-    builder.process_text_auto()
+        def on_change(changed_paths):
+            rebuild_time_start = time.time()
+            try:
+                rebuild(workers=workers)
+                print(colored('REBUILD SUCCESSFUL', 'green', 'on_grey'), ' -> Rebuild time: {0}'.format(time.time() - rebuild_time_start))
+            except Exception as e:
+                print(colored('REBUILD ERROR', 'red'), e)
 
-    if config['templates']['build_nav'] and needs_rebuild:
-        builder.build_nav(files, use_absolute_links=False)
+        watch_config = config.get('watch', {})
+        watch([config['input']['input_dir'], config['templates']['path']] + additional_templates, on_change,
+              ignore=[config['output']['output_dir'], config['log']['output_dir']],
+              debounce=watch_config.get('debounce', 0.05), interval=watch_config.get('interval', 0.1))
+        exit()
+    elif args.command == 'serve':
+        from server import serve
+        # Build once on startup, afterwards only on notifications
+        build(files, ok, force_rebuild=args.force_rebuild, workers=workers, verify=args.verify)
+        server_config = config.get('server', {})
+        serve(lambda pages: rebuild(workers=workers),
+              host=args.host or server_config.get('host', '127.0.0.1'),
+              port=args.port or server_config.get('port', 8765),
+              debounce=server_config.get('debounce', 0.05))
+        exit()
 
-    # Render html to Jinja template
-    builder.build(minify_html=config['output']['minify_html'])
+    build(files, ok, force_rebuild=args.force_rebuild, workers=workers, verify=args.verify)
 
-    # Update log file after the successful build
-    log.write()
+    if args.profile:
+        tracing.print_profile(args.profile)
+    if args.trace:
+        tracing.write_chrome_trace(args.trace)
 
+    peak_memory, peak_memory_workers = get_peak_memory()
+    if peak_memory:
+        print(colored('Peak memory', 'grey'), '-> {0:.1f} MB, workers {1:.1f} MB'.format(peak_memory, peak_memory_workers))
     print(colored('BUILD SUCCESSFUL', 'green', 'on_grey'), ' -> Build time: {0}'.format(time.time() - build_time_start))
@@ -19,7 +19,10 @@ blank_config = {
     },
     'log': {
         'output_dir': '',
-        'file_name': 'log.json'
+        'backend': 'json',
+        'file_name': 'log.json',
+        'db_name': 'log.sqlite',
+        'hash_algorithm': 'md5'
     },
     'files': {
         'meta_types': [],
@@ -41,12 +44,49 @@ blank_config = {
         'minify_html': True
     },
     'processing': {
+        'workers': 1,
+        'batch_size': 1000,
         'use_nltk': False,
         'min_word_length': 2,
         'keyword_extraction': True,
-        'summary_generation': True
+        'summary_generation': True,
+        'language': 'english',
+        'keyword_count': 10,
+        'summary_sentences': 2,
+        'keyword_engine': 'frequency'
     },
     'plugins': {
         'path': 'plugins'
+    },
+    'assets': {
+        'types': ['css', 'js', 'png', 'jpg', 'jpeg', 'gif', 'svg', 'webp', 'ico', 'woff', 'woff2', 'pdf'],
+        'fingerprint': False,
+        'link': 'hardlink'
+    },
+    'sitemap': {
+        'enabled': False,
+        'base_url': '',
+        'shard_size': 50000,
+        'gzip': False,
+        'robots': True,
+        'robots_disallow': []
+    },
+    'cache': {
+        'render_cache': True,
+        'render_cache_max_size': 256 * 1024 * 1024,
+        'parse_cache': True,
+        'parse_cache_max_size': 256 * 1024 * 1024,
+        'derivative_cache_max_size': 1024 * 1024 * 1024,
+        'hook_cache': True,
+        'hook_cache_max_size': 256 * 1024 * 1024
+    },
+    'watch': {
+        'interval': 0.1,
+        'debounce': 0.05
+    },
+    'server': {
+        'host': '127.0.0.1',
+        'port': 8765,
+        'debounce': 0.05
     }
 }
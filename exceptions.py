@@ -18,6 +18,10 @@ class LogEntriesNotADirectoryError(Exception):
     pass
 
 
+class LogUnknownStoreError(Exception):
+    pass
+
+
 class LoaderWrongFileError(Exception):
     pass
 
@@ -1,9 +1,12 @@
 import hashlib
 import io
+import json
 import re
+import stat
+import sys
+import tempfile
 import unicodedata
 from configuration import *
-from writer.writers import find_writer_for_ext
 
 
 def file_get_extension(file, strip_dot=False):
@@ -32,12 +35,185 @@ def contents_get_hash_md5(contents):
     return md5.hexdigest()
 
 
+def contents_get_hash(contents, algorithm='md5'):
+    """
+    Returns the hex digest of the given contents using any hashlib algorithm (i.e. md5, sha1, blake2b)
+    """
+    h = hashlib.new(algorithm)
+    h.update(contents)
+    return h.hexdigest()
+
+
+def meta_get_nav_summary(meta, fields=('title', 'slug', 'status', 'visibility')):
+    """
+    Returns the meta fields that are used by the navigation (see Builder.build_nav)
+    """
+    return {field: meta.get(field) for field in fields}
+
+
+def meta_get_nav_fingerprint(meta):
+    """
+    Returns a hash over the meta fields that are used by the navigation
+    """
+    return contents_get_hash(json.dumps(meta_get_nav_summary(meta), sort_keys=True).encode('utf-8'))
+
+
+def config_is_enabled(value):
+    """
+    Config flags may be given as booleans or as strings (i.e. 'True')
+    """
+    return value is True or str(value).lower() in ['true', 'yes', '1']
+
+
+def file_get_hash(file, algorithm='md5', block_size=2**16):
+    """
+    Returns the hex digest of a (binary) file, read block by block
+    """
+    file_hash = hashlib.new(algorithm)
+    with io.open(file, 'rb') as file_open:
+        for d_chunk in iter(lambda: file_open.read(block_size), b''):
+            file_hash.update(d_chunk)
+    return file_hash.hexdigest()
+
+
+def file_get_stat(file):
+    """
+    Returns the (size, mtime_ns, inode) tuple of a file path or os.DirEntry as list (JSON-able)
+    """
+    stat = file.stat() if isinstance(file, os.DirEntry) else os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def asset_get_output(name, file_hash, fingerprint=False):
+    """
+    Returns the output path of an asset, with fingerprint the content hash is part of the file name,
+    i.e. images/logo.png -> images/logo.3f2a9c81d0e4.png
+    """
+    if not fingerprint:
+        return name
+    stem, ext = os.path.splitext(name)
+    return '{0}.{1}{2}'.format(stem, file_hash[:12], ext)
+
+
 def safe_create_dir(file):
     dir_name = os.path.dirname(file)
     if not os.path.exists(dir_name):
         os.makedirs(dir_name, exist_ok=True)
 
 
+def get_peak_memory():
+    """
+    Returns the peak resident set size in MB of this process and of its (finished) worker processes,
+    None where the resource module isn't available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None
+
+    # ru_maxrss is given in kilobytes on Linux, but in bytes on macOS
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+
+def file_write_atomic(file, contents, encoding='utf-8'):
+    """
+    Writes contents (str or bytes) to a temporary file next to the given file and replaces the file with it,
+    so readers never see a half-written file
+    """
+    safe_create_dir(file)
+    mode = stat.S_IMODE(os.stat(file).st_mode) if os.path.exists(file) else 0o644
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file) or os.curdir, prefix='.', suffix='.tmp')
+    try:
+        with (io.open(fd, 'wb') if isinstance(contents, bytes) else io.open(fd, 'w', encoding=encoding)) as tmp_file:
+            tmp_file.write(contents)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def dir_evict_lru(path, max_size):
+    """
+    Removes the least recently used (oldest mtime) files inside path until all files fit into max_size bytes
+    Returns the number of removed files
+    """
+    if not os.path.isdir(path):
+        return 0
+
+    cached = []
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_stat = os.stat(os.path.join(dir_path, file_name))
+            cached.append((file_stat.st_mtime_ns, file_stat.st_size, os.path.join(dir_path, file_name)))
+
+    total_size = sum(size for _, size, _ in cached)
+    removed = 0
+    for _, size, file_path in sorted(cached):
+        if total_size <= max_size:
+            break
+        os.remove(file_path)
+        total_size -= size
+        removed += 1
+    return removed
+
+
+class DiskCache:
+    """
+    Base of the caches kept on disk (see loader.cache and builder.cache)
+    Each entry is a file below path named by its key, hits refresh its mtime, so evict() can remove
+    the least recently used entries first. Subclasses define the file extension and how entries are (de)serialized,
+    _loads() returns None for broken entries, which then count as misses.
+    """
+    extension = '.bin'
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def _key_path(self, key):
+        return os.path.join(self.path, key[:2], key + self.extension)
+
+    def _dumps(self, value):
+        return value
+
+    def _loads(self, data):
+        return data
+
+    def get(self, key):
+        """
+        Returns the cached entry for key or None
+        """
+        key_path = self._key_path(key)
+        try:
+            with io.open(key_path, 'rb') as cache_file:
+                value = self._loads(cache_file.read())
+            os.utime(key_path)
+        except OSError:
+            value = None
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        file_write_atomic(self._key_path(key), self._dumps(value))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits into max_size
+        Returns the number of removed entries
+        """
+        return dir_evict_lru(self.path, self.max_size)
+
+
 # Taken from https://github.com/django/django/blob/master/django/utils/text.py
 def slugify(value, allow_unicode=False):
     """
@@ -58,6 +234,8 @@ def write_disk_meta(meta_dict):
     """
     Write meta_converted to actual file
     """
+    from writer.writers import find_writer_for_ext
+
     outfile_path = os.path.join(input_dir, meta_dict['slug'] + '.{type}'.format(type=default_meta_type))
 
     writer_meta = find_writer_for_ext(default_meta_type)()
@@ -18,3 +18,17 @@ def emit_hook(hook, *payload):
         return initial_payload
     except KeyError:
         pass
+
+
+def emit_hook_batch(hook, payloads):
+    """
+    Emits a hook on a list of payloads, subscribers implementing <hook>_batch get all payloads at once,
+    the others one payload at a time
+    """
+    for subscriber in hook_subscribers.get(hook, []):
+        batch_hook = getattr(subscriber, hook + '_batch', None)
+        if batch_hook:
+            payloads = batch_hook(payloads)
+        else:
+            payloads = [getattr(subscriber, hook)(payload) for payload in payloads]
+    return payloads
@@ -0,0 +1,29 @@
+import pickle
+import zlib
+from helpers import DiskCache, contents_get_hash
+
+
+class ParseCache(DiskCache):
+    """
+    Persistent cache of loader output (loaded meta dicts and page html)
+    Keys are hashes over the raw contents as passed to the loader (i.e. after the before_load hooks),
+    the loader class and its version, so contents transformed differently by a plugin never hit a stale entry.
+    Entries are stored as zlib compressed pickles.
+    """
+    @staticmethod
+    def key(loader_class, contents):
+        """
+        Returns the cache key for loading contents (bytes) with loader_class
+        """
+        loader_id = '{0}.{1}:{2}'.format(loader_class.__module__, loader_class.__qualname__, loader_class.version)
+        return contents_get_hash(loader_id.encode('utf-8') + b'\0' + contents, 'sha256')
+
+    def _dumps(self, loaded):
+        return zlib.compress(pickle.dumps(loaded, pickle.HIGHEST_PROTOCOL))
+
+    def _loads(self, data):
+        try:
+            return pickle.loads(zlib.decompress(data))
+        except (zlib.error, pickle.UnpicklingError, EOFError):
+            # Broken entries are simply loaded again
+            return None
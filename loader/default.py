@@ -5,7 +5,10 @@ class AMetaLoader(ABC):
     """
     Abstract class for implementing specific meta loaders
     Each meta loader could expand che's abilities to load multiple meta file formats
+    Raise version whenever the loader's output changes, it's part of the parse cache key
     """
+    version = 1
+
     def __init__(self):
         pass
 
@@ -18,7 +21,10 @@ class APageLoader(ABC):
     """
     Abstract class for implementing specific page loaders
     Each page loader could expand che's abilities to load multiple page file formats
+    Raise version whenever the loader's output changes, it's part of the parse cache key
     """
+    version = 1
+
     def __init__(self):
         pass
 
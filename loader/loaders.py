@@ -21,3 +21,11 @@ def find_loader_for_ext(ext):
         return next(filter(lambda l: ext in l['ext'], available_loaders))['loader']
     except StopIteration:
         raise LoaderNoSuitableLoaderError('No suitable loader found for this file type')
+
+
+def load_contents(ext, contents):
+    """
+    Loads the given raw contents with a suitable loader for ext
+    load_pages (see log.raw_entry) maps it over the parse cache misses on a process pool
+    """
+    return find_loader_for_ext(ext)().read(contents)
@@ -1,4 +1,3 @@
-import mistune
 from loader.default import APageLoader
 
 
@@ -8,4 +7,5 @@ class PageLoaderMarkdown(APageLoader):
     Reads a given markdown file into html
     """
     def read(self, contents):
+        import mistune
         return mistune.markdown(contents.decode('utf-8'))
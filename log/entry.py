@@ -12,6 +12,19 @@ class Entry:
             self.last_modified = field_initializer['last_modified']
             self.hash_meta = field_initializer['hash_meta']
             self.hash_file = field_initializer['hash_file']
+            self.stat_meta = field_initializer.get('stat_meta')
+            self.stat_file = field_initializer.get('stat_file')
+            self.hash_output = field_initializer.get('hash_output')
+            self.hash_nav = field_initializer.get('hash_nav')
+            self.nav = field_initializer.get('nav')
+            self.references = field_initializer.get('references', [])
+            self.template = field_initializer.get('template')
+            self.hash_template = field_initializer.get('hash_template')
+            self.keywords = field_initializer.get('keywords', [])
+            self.summary = field_initializer.get('summary', '')
+            self.hash_nlp = field_initializer.get('hash_nlp')
+            self.kind = field_initializer.get('kind', 'page')
+            self.output = field_initializer.get('output')
         else:
             self.file = filename
             self.uid = None
@@ -19,6 +32,19 @@ class Entry:
             self.last_modified = None
             self.hash_meta = None
             self.hash_file = None
+            self.stat_meta = None
+            self.stat_file = None
+            self.hash_output = None
+            self.hash_nav = None
+            self.nav = None
+            self.references = []
+            self.template = None
+            self.hash_template = None
+            self.keywords = []
+            self.summary = ''
+            self.hash_nlp = None
+            self.kind = 'page'
+            self.output = None
 
     def serialize(self):
         """
@@ -30,7 +56,20 @@ class Entry:
             'version': self.version,
             'last_modified': str(self.last_modified),
             'hash_meta': self.hash_meta,
-            'hash_file': self.hash_file
+            'hash_file': self.hash_file,
+            'stat_meta': self.stat_meta,
+            'stat_file': self.stat_file,
+            'hash_output': self.hash_output,
+            'hash_nav': self.hash_nav,
+            'nav': self.nav,
+            'references': self.references,
+            'template': self.template,
+            'hash_template': self.hash_template,
+            'keywords': self.keywords,
+            'summary': self.summary,
+            'hash_nlp': self.hash_nlp,
+            'kind': self.kind,
+            'output': self.output
         }
 
     def update(self):
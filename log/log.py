@@ -1,6 +1,5 @@
-import io
-import json
 import os
+import sqlite3
 import uuid
 from datetime import datetime
 from termcolor import colored
@@ -8,27 +7,63 @@ try:
     from configuration import config
 except ImportError:
     pass
+from builder.template import get_template_hash
 from exceptions import *
-from helpers import file_get_extension, contents_get_hash_md5, safe_create_dir
-from hooks import emit_hook, HOOK_BEFORE_LOAD, HOOK_AFTER_LOAD
-from loader.loaders import find_loader_for_ext
+from helpers import asset_get_output, config_is_enabled, file_get_extension, file_get_hash, file_get_stat, meta_get_nav_fingerprint, meta_get_nav_summary, safe_create_dir
 from log.entry import Entry
+from log.store import get_store
+from log import raw_entry
+from log.raw_entry import RawEntry, FIELDS
+from loader.cache import ParseCache
+
+# Rules that caused a rebuild, see convert_raw_entries()
+REBUILD_ADDED = 'added'
+REBUILD_REMOVED = 'removed'
+REBUILD_NAV = 'nav fields changed'
+REBUILD_META = 'meta changed'
+REBUILD_PAGE = 'page changed'
+REBUILD_REFERENCE = 'referenced page changed'
+REBUILD_ASSET = 'referenced asset changed'
+REBUILD_TEMPLATE = 'template changed'
+REBUILD_COMPLETE = 'complete rebuild'
+REBUILD_FORCED = 'forced rebuild'
+rebuild_reasons = {}
+
+# The log keeps its entries indexed by file name (insertion ordered) and by uid
+entries = {}
+entries_by_uid = {}
+# Reverse index of page references: uid of the referenced page -> file names of the referencing pages
+referrers = {}
+
+
+def _index(entry):
+    entries[entry.file] = entry
+    entries_by_uid[str(entry.uid)] = entry
+    for uid in entry.references:
+        referrers.setdefault(uid, set()).add(entry.file)
+
+
+def reload():
+    """
+    Replaces the entries in memory by the ones of the log store,
+    i.e. to drop the changes of a failed build within a long running process (watch, serve)
+    """
+    entries.clear()
+    entries_by_uid.clear()
+    referrers.clear()
+    rebuild_reasons.clear()
+    for t in store.load():
+        _index(Entry(filename=None, field_initializer=t))
 
-try:
-    log_file_path = os.path.join(config['log']['output_dir'], config['log']['file_name'])
-    entries = []
 
+try:
     # Initially load entries into the log
-    safe_create_dir(config['log']['output_dir'])
-    with io.open(log_file_path, 'r', encoding='utf-8') as log_file_open:
-        try:
-            entries = []
-            tmp_entries = json.load(log_file_open)
-            for t in tmp_entries:
-                new_entry = Entry(filename=None, field_initializer=t)
-                entries.append(new_entry)
-        except json.decoder.JSONDecodeError:
-            entries = []
+    store = get_store(config['log'])
+    reload()
+
+    if config_is_enabled(config.get('cache', {}).get('parse_cache', True)):
+        raw_entry.parse_cache = ParseCache(os.path.join(config['log']['output_dir'], 'parse_cache'),
+                                           max_size=config.get('cache', {}).get('parse_cache_max_size', 256 * 1024 * 1024))
 except NameError:
     pass
 
@@ -41,22 +76,66 @@ def _file_is_page(ext):
     return ext in config['files']['page_types']
 
 
-def load_raw_entries(path):
+def _file_is_asset(ext):
+    return ext.lower() in config.get('assets', {}).get('types', [])
+
+
+def _hash_algorithm():
+    return config['log'].get('hash_algorithm', 'md5')
+
+
+def _stat_unchanged(f_entry, field, stat):
+    """
+    Compares the stat tuple (size, mtime_ns, inode) of a file with the one stored in the log entry
+    """
+    logged_stat = f_entry.stat_meta if field == 'meta' else f_entry.stat_file
+    return logged_stat is not None and list(logged_stat) == list(stat)
+
+
+def _scan_files(path):
+    """
+    Yields (dir entry, field, extension, file name) of all meta and page files in path, sorted by name
+    Only the names are sorted up front, the stat information is taken entry by entry
+    """
+    for dir_entry in sorted(os.scandir(path), key=lambda d: d.name):
+
+        if dir_entry.is_file():
+
+            # Finding meta and page files
+            ext, fn = file_get_extension(dir_entry.name, strip_dot=True)
+
+            if _file_is_meta(ext):
+                yield dir_entry, 'meta', ext, fn
+            elif _file_is_page(ext):
+                yield dir_entry, 'page', ext, fn
+            # Skip unrelated files (assets are found by load_assets())
+
+
+def load_raw_entries(path, verify=False, workers=1):
     """
     Load a given directory containing meta (json) and page data (md)
-    Returns a list of all found entries in the form:
+    Returns a dict of lazy RawEntry pairs (see log.raw_entry) in the form:
         ...
         'file': {
             'meta': {
-                'contents': ...,
-                'hash': ...
+                'type': ...,
+                'path': ...,
+                'stat': ...,
+                'hash': ...,
+                'loaded': ...  (parsed on access)
             },
             'page': {
-                'contents': ...,
-                'hash': ...
+                ...
             }
         }
         ...
+    Changed pairs are hashed block by block and their meta is parsed right away, as it is small and needed for status
+    and nav. Pages are only read (firing before_load) and converted when the Builder builds them.
+    Pairs whose files still match the stat tuple (size, mtime_ns, inode) stored in the log are not opened at all,
+    they carry the logged hashes and are read on first access.
+    Use verify to read and hash every file regardless of its stat information.
+    With workers > 1 the files are hashed by a thread pool.
+    No page is held in memory, so the memory needed doesn't grow with the size of the site.
     """
     if not os.path.isdir(path):
         safe_create_dir(path)
@@ -64,66 +143,156 @@ def load_raw_entries(path):
     found_files = {}
 
     print(colored('Finding meta and page files in...', 'yellow'), path)
-    for file in os.listdir(path):
-        absolute_file_path = os.path.join(path, file)
+    for dir_entry, field, ext, fn in _scan_files(path):
+        if fn not in found_files:
+            found_files[fn] = RawEntry(fn, hash_algorithm=_hash_algorithm())
+
+        found_files[fn][field]['type'] = ext
+        found_files[fn][field]['path'] = dir_entry.path
+        found_files[fn][field]['stat'] = file_get_stat(dir_entry)
+
+    changed_pairs = []
+    for fn in found_files:
+        f_entry = find(name=fn)
+        fields = [field for field in FIELDS if found_files[fn][field]]
+
+        if not verify and f_entry:
+            # Take the hashes of files with an unchanged stat tuple from the log instead of hashing them again
+            for field in fields:
+                if _stat_unchanged(f_entry, field, found_files[fn][field]['stat']):
+                    found_files[fn][field]['hash'] = f_entry.hash_meta if field == 'meta' else f_entry.hash_file
+
+        if all('hash' in found_files[fn][field] for field in fields):
+            # Unchanged pair, don't open the files until they are needed
+            continue
+
+        changed_pairs.append(found_files[fn])
+
+    # Keep only the hashes and the meta of changed pairs, the pages are read once they are built
+    if workers > 1 and len(changed_pairs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as io_pool:
+            list(io_pool.map(RawEntry.hash_files, changed_pairs))
+    for entry_pair in changed_pairs:
+        entry_pair.hash_files()
+        entry_pair.load('meta')
 
-        if os.path.isfile(absolute_file_path):
+    return found_files, [len(e) == 2 for e in found_files]
 
-            # Finding meta and page files
-            ext, fn = file_get_extension(file, strip_dot=True)
 
-            # Read raw contents
-            with io.open(absolute_file_path, 'rb') as raw_file:
-                raw_contents = raw_file.read()
+def load_assets(path, verify=False):
+    """
+    Finds the assets (assets.types, i.e. images, stylesheets, fonts) in path and its sub directories
+    Returns a dict of asset name (path relative to the given path) -> {'path': ..., 'stat': ..., 'hash': ...}
+    Like pages, only new assets and assets whose stat tuple differs from the log (or all with verify) are hashed
+    """
+    found_assets = {}
+    if not os.path.isdir(path):
+        return found_assets
 
-            if _file_is_meta(ext):
-                field = 'meta'
-            elif _file_is_page(ext):
-                field = 'page'
-            else:
-                # Skip unrelated files
-                # TODO: Add other cases for images, stylesheets etc. (assets)
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            ext, _ = file_get_extension(file_name, strip_dot=True)
+            if not _file_is_asset(ext):
                 continue
 
-            f_hash = contents_get_hash_md5(raw_contents)
+            file_path = os.path.join(dir_path, file_name)
+            name = os.path.relpath(file_path, path).replace(os.sep, '/')
+            asset = {'path': file_path, 'stat': file_get_stat(file_path)}
 
-            if fn not in found_files:
-                found_files[fn] = {
-                    'meta': {},
-                    'page': {}
-                }
+            f_entry = find(name=name)
+            if not verify and f_entry and f_entry.kind == 'asset' and _stat_unchanged(f_entry, 'page', asset['stat']):
+                asset['hash'] = f_entry.hash_file
+            else:
+                asset['hash'] = file_get_hash(file_path, _hash_algorithm())
+            found_assets[name] = asset
 
-            found_files[fn][field]['type'] = ext
-            found_files[fn][field]['contents'] = raw_contents
+    return found_assets
 
-            # Call before_load hooks on each file before the actual loader loads the file
-            # This hook is fired, as soon as we've collected both, meta and page information
-            if len(found_files[fn]['meta']) and len(found_files[fn]['page']):
-                found_files[fn] = emit_hook(HOOK_BEFORE_LOAD, found_files[fn])
 
-            # Find suitable loaders for meta and page contents
-            loader = find_loader_for_ext(ext)()
-            if not loader:
-                raise LoaderNoSuitableLoaderError('No suitable loader found for this type')
+def convert_assets(found_assets, fingerprint=False):
+    """
+    Compares the found assets with the log, assets are logged as entries of kind asset
+    Returns
+        - the names of new or changed assets, which need to be published
+        - the outputs (relative to the output dir) of removed assets or of assets published under a new
+          fingerprinted name, which need to be removed after the build
+        - the entries of assets whose url has changed, the pages referencing them need to be rebuilt
+    """
+    changed_assets = []
+    stale_outputs = []
+    url_changes = []
 
-            found_files[fn][field]['loaded'] = loader.read(raw_contents)
-            found_files[fn][field]['hash'] = f_hash
+    for name, asset in found_assets.items():
+        f_entry = find(name=name)
+        output = asset_get_output(name, asset['hash'], fingerprint)
 
-            # Call after_load hooks on each file after the actual loader has loaded the file
-            # This hook is fired, as soon as we've collected both, meta and page information
-            if len(found_files[fn]['meta']) and len(found_files[fn]['page']):
-                found_files[fn] = emit_hook(HOOK_AFTER_LOAD, found_files[fn])
+        if not f_entry:
+            print(colored('Added new asset', 'green'), colored(name, 'magenta'))
+            f_entry = Entry(name)
+            f_entry.kind = 'asset'
+            f_entry.hash_file = asset['hash']
+            f_entry.stat_file = asset['stat']
+            f_entry.output = output
+            insert(f_entry)
+            changed_assets.append(name)
+            continue
+
+        f_entry.stat_file = asset['stat']
+        if f_entry.hash_file == asset['hash'] and f_entry.output == output:
+            continue
+
+        print(colored('Asset changed', 'red'), name)
+        if f_entry.output != output:
+            stale_outputs.append(f_entry.output)
+            url_changes.append(f_entry)
+
+        f_entry.hash_file = asset['hash']
+        f_entry.output = output
+        f_entry.update()
+        changed_assets.append(name)
+
+    for f_entry in [e for e in entries.values() if e.kind == 'asset' and e.file not in found_assets]:
+        print(colored('Removed asset', 'red'), colored(f_entry.file, 'magenta'))
+        stale_outputs.append(f_entry.output)
+        url_changes.append(f_entry)
+        remove(f_entry)
+
+    return changed_assets, stale_outputs, url_changes
+
+
+def find_asset_outputs():
+    """
+    Returns the outputs of all logged assets by asset name
+    """
+    return {e.file: e.output for e in entries.values() if e.kind == 'asset'}
 
-    return found_files, [len(e) == 2 for e in found_files]
 
+def _update_entry_from_pair(entry, entry_pair):
+    entry.hash_meta = entry_pair['meta']['hash']
+    entry.hash_file = entry_pair['page']['hash']
+    entry.stat_meta = entry_pair['meta']['stat']
+    entry.stat_file = entry_pair['page']['stat']
 
-def convert_raw_entries(found_entries):
+
+def convert_raw_entries(found_entries, changed_assets=()):
     """
     Returns a dict of changed files (including meta and page information) of changed files
     by comparing the files' hashes with the ones stored in the log
+    Unchanged files are rebuilt if the closure of the template they have been built with has changed.
+    A complete rebuild is only needed (with build_nav enabled) if pages are added or removed,
+    or if the nav fingerprint (see helpers.meta_get_nav_fingerprint) of a changed meta file differs from the log.
+    Pages referencing any of the given changed_assets (asset entries whose url has changed, see convert_assets)
+    are rebuilt as well.
+    The rule that caused the rebuild of each page is collected in rebuild_reasons
     """
     changed_files = {}
     needs_complete_rebuild = False
+    build_nav = config['templates']['build_nav']
+    rebuild_reasons.clear()
+    # Entries whose title or slug may have changed, the pages referencing them need to be rebuilt
+    referenced_changes = []
 
     for entry_pair in found_entries:
         f_entry = find(name=entry_pair)
@@ -133,37 +302,108 @@ def convert_raw_entries(found_entries):
             print(colored('Added new file', 'green'), '[meta]', colored(entry_pair, 'magenta'))
 
             entry = Entry(entry_pair)
-            entry.hash_meta = found_entries[entry_pair]['meta']['hash']
-            entry.hash_file = found_entries[entry_pair]['page']['hash']
+            _update_entry_from_pair(entry, found_entries[entry_pair])
+            entry.hash_nav = meta_get_nav_fingerprint(found_entries[entry_pair]['meta']['loaded'])
+            entry.nav = meta_get_nav_summary(found_entries[entry_pair]['meta']['loaded'])
             insert(entry)
 
+            changed_files[entry_pair] = found_entries[entry_pair]
+            rebuild_reasons[entry_pair] = REBUILD_ADDED
+
             # If we add a new file and build_nav is enabled, we need to rebuild every page, as we
             # include the nav to all the files
-            if config['templates']['build_nav']:
+            if build_nav:
                 needs_complete_rebuild = True
                 print(colored('Need to rebuild every page due to build_nav option', 'red'))
         else:
             # File is in log already, compare hashes to find any changes
             if f_entry.hash_meta == found_entries[entry_pair]['meta']['hash'] \
                     and f_entry.hash_file == found_entries[entry_pair]['page']['hash']:
+                # Remember the current stat tuple (i.e. after a touch)
+                f_entry.stat_meta = found_entries[entry_pair]['meta']['stat']
+                f_entry.stat_file = found_entries[entry_pair]['page']['stat']
+
+                # The page's template or any template in its extends / include / import closure has changed
+                if f_entry.template and f_entry.hash_template != get_template_hash(f_entry.template):
+                    print(colored('File needs to be rebuild due to changed template', 'red'), entry_pair)
+                    changed_files[entry_pair] = found_entries[entry_pair]
+                    rebuild_reasons[entry_pair] = REBUILD_TEMPLATE
+                    continue
+
                 # Skipping file as there are no changes
                 print(colored('Skipping file due to no changes', 'magenta'), entry_pair)
                 continue
             else:
                 # There are changes so update the entry and add the file to the change list
+                rebuild_reasons[entry_pair] = REBUILD_PAGE
+
                 if f_entry.hash_meta != found_entries[entry_pair]['meta']['hash']:
-                    needs_complete_rebuild = True
+                    rebuild_reasons[entry_pair] = REBUILD_META
+
+                    # Only changes to fields that end up in the nav affect the other pages
+                    hash_nav = meta_get_nav_fingerprint(found_entries[entry_pair]['meta']['loaded'])
+                    f_entry.nav = meta_get_nav_summary(found_entries[entry_pair]['meta']['loaded'])
+                    if f_entry.hash_nav != hash_nav:
+                        f_entry.hash_nav = hash_nav
+                        rebuild_reasons[entry_pair] = REBUILD_NAV
+                        referenced_changes.append(f_entry)
+                        if build_nav:
+                            needs_complete_rebuild = True
+                            print(colored('Need to rebuild every page due to changed nav fields', 'red'), entry_pair)
 
                 print(colored('File needs to be rebuild', 'red'), entry_pair)
-                f_entry.hash_meta = found_entries[entry_pair]['meta']['hash']
-                f_entry.hash_file = found_entries[entry_pair]['page']['hash']
+                _update_entry_from_pair(f_entry, found_entries[entry_pair])
                 f_entry.update()
 
                 changed_files[entry_pair] = found_entries[entry_pair]
 
+    # Entries in the log without any files have been removed
+    for f_entry in [e for e in entries.values() if e.kind == 'page' and e.file not in found_entries]:
+        print(colored('Removed file', 'red'), '[meta]', colored(f_entry.file, 'magenta'))
+        remove(f_entry)
+        rebuild_reasons[f_entry.file] = REBUILD_REMOVED
+        referenced_changes.append(f_entry)
+        if build_nav:
+            needs_complete_rebuild = True
+            print(colored('Need to rebuild every page due to build_nav option', 'red'))
+
+    # Rebuild exactly the pages referencing a page with a changed title or slug
+    for f_entry in referenced_changes:
+        for referrer in find_referrers(f_entry):
+            if referrer in found_entries and referrer not in changed_files:
+                print(colored('File needs to be rebuild due to changed reference', 'red'), referrer, '->', f_entry.file)
+                changed_files[referrer] = found_entries[referrer]
+                rebuild_reasons[referrer] = REBUILD_REFERENCE
+
+    for f_entry in changed_assets:
+        for referrer in find_referrers(f_entry):
+            if referrer in found_entries and referrer not in changed_files:
+                print(colored('File needs to be rebuild due to changed asset', 'red'), referrer, '->', f_entry.file)
+                changed_files[referrer] = found_entries[referrer]
+                rebuild_reasons[referrer] = REBUILD_ASSET
+
     return changed_files, needs_complete_rebuild
 
 
+def print_rebuild_summary(build_files, forced=False):
+    """
+    Prints the rule that caused the rebuild for each of the given files
+    Files without a rule of their own are rebuilt as part of a complete (or forced) rebuild
+    """
+    summary = {}
+    for entry_pair in build_files:
+        reason = rebuild_reasons.get(entry_pair, REBUILD_FORCED if forced else REBUILD_COMPLETE)
+        summary.setdefault(reason, []).append(entry_pair)
+
+    removed = [e for e, reason in rebuild_reasons.items() if reason == REBUILD_REMOVED]
+    if removed:
+        summary[REBUILD_REMOVED] = removed
+
+    print(colored('Rebuild summary', 'grey'))
+    for reason, files in summary.items():
+        print(' {0}: {1} -> {2}{3}'.format(reason, len(files), ', '.join(files[:10]), ', ...' if len(files) > 10 else ''))
+
+
 def insert(entry):
     """
     Insert a new loggable object to the log
@@ -172,7 +412,7 @@ def insert(entry):
     if not entry.file:
         raise LogNoLoggableEntryError('Given entry is a non-loggable object')
 
-    if [e for e in entries if e.file == entry.file]:
+    if entry.file in entries:
         raise LogEntryAlreadyInLogError('Given entry is already in the log')
 
     entry.last_modified = datetime.now()
@@ -180,23 +420,69 @@ def insert(entry):
         entry.version = 1
 
     entry.uid = uuid.uuid4()
-    entries.append(entry)
+    _index(entry)
+
+
+def remove(entry):
+    """
+    Remove an entry from the log
+    """
+    if entries.get(entry.file) is not entry:
+        raise LogEntryNotInLogError('Given entry is not in the log')
+
+    del entries[entry.file]
+    entries_by_uid.pop(str(entry.uid), None)
+    for uid in entry.references:
+        referrers.get(uid, set()).discard(entry.file)
+
+
+def set_references(entry, target_uids):
+    """
+    Replace the outgoing page references of an entry and update the reverse index
+    """
+    for uid in entry.references:
+        referrers.get(uid, set()).discard(entry.file)
+
+    entry.references = sorted(set(str(uid) for uid in target_uids))
+    for uid in entry.references:
+        referrers.setdefault(uid, set()).add(entry.file)
+
+
+def find_referrers(entry):
+    """
+    Returns the file names of all pages referencing the given entry
+    """
+    return sorted(referrers.get(str(entry.uid), set()))
+
+
+def find_nav_summary(name, entry_pair):
+    """
+    Returns the nav summary (title, slug, status, visibility) of a page from the log without loading its files
+    Entries logged without a summary yet take it from the (lazily loaded) meta once
+    """
+    f_entry = find(name=name)
+    if f_entry and f_entry.nav:
+        return f_entry.nav
+
+    summary = meta_get_nav_summary(entry_pair['meta']['loaded'])
+    if f_entry:
+        f_entry.nav = summary
+    return summary
 
 
 def find(name, uid=None):
     """
-    Returns the entry for given uid
+    Returns the entry for given uid or file name
     """
-    return next(filter(lambda e: e.uid == uid, entries), None) if uid else next(filter(lambda e: e.file == name, entries), None)
+    return entries_by_uid.get(str(uid)) if uid else entries.get(name)
 
 
 def write():
     """
-    Write all entries (created, existing or modified) to the log file
+    Write all entries (created, existing or modified) to the log store
+    Depending on the store backend only the changed entries are written
     """
-    with io.open(log_file_path, 'w', encoding='utf-8') as log_file_write:
-        try:
-            if log_file_write.writable():
-                json.dump([e.serialize() for e in entries], log_file_write, ensure_ascii=False)
-        except ValueError:
-            raise LogNotWriteableError('Log is not writable')
\ No newline at end of file
+    try:
+        store.write([e.serialize() for e in entries.values()])
+    except (ValueError, OSError, sqlite3.Error):
+        raise LogNotWriteableError('Log is not writable')
@@ -0,0 +1,241 @@
+import io
+from helpers import contents_get_hash, file_get_hash
+import tracing
+from hooks import emit_hook_batch, HOOK_BEFORE_LOAD, HOOK_AFTER_LOAD
+from loader.loaders import find_loader_for_ext, load_contents
+
+FIELDS = ['meta', 'page']
+
+# Optional loader.cache.ParseCache, set up by the log
+parse_cache = None
+
+
+class RawEntryField(dict):
+    """
+    A single [meta] or [page] file of a RawEntry
+    Accessing 'contents' or 'loaded' reads or loads the file on demand
+    """
+    def __init__(self, entry, field):
+        super().__init__()
+        self.entry = entry
+        self.field = field
+
+    def __missing__(self, key):
+        if 'path' in self:
+            if key == 'contents':
+                self.entry.read()
+            elif key == 'loaded':
+                self.entry.load(self.field)
+        if key not in self:
+            raise KeyError(key)
+        return self.get(key)
+
+    def release(self):
+        """
+        Drop the raw bytes of this file
+        """
+        self.pop('contents', None)
+
+
+class RawEntry(dict):
+    """
+    Lazy entry pair of a [meta] and a [page] file, as returned by log.load_raw_entries()
+
+    The files are only read when their contents are needed, the page is only converted by its loader
+    when its 'loaded' html is accessed (i.e. when the Builder renders the page).
+    The meta alone can be loaded up front (i.e. for status and nav of changed pairs) without reading the page
+    or firing any hooks, it's loaded again from the hooked contents once the pair is read for building.
+    Raw bytes are released as soon as a file has been loaded.
+    Hooks keep their pair semantics: before_load is fired once after both raw files have been read,
+    after_load is fired once after both files have been loaded.
+    """
+    def __init__(self, name, hash_algorithm='md5'):
+        super().__init__()
+        self['meta'] = RawEntryField(self, 'meta')
+        self['page'] = RawEntryField(self, 'page')
+        self.name = name
+        self.hash_algorithm = hash_algorithm
+        self.files_read = False
+        self.is_read = False
+
+    def is_pair(self):
+        return len(self['meta']) > 0 and len(self['page']) > 0
+
+    def _emit(self, hook):
+        _emit_batch(hook, [self])
+
+    def _read_file(self, field):
+        with io.open(self[field]['path'], 'rb') as raw_file:
+            self[field]['contents'] = raw_file.read()
+
+        if 'hash' not in self[field]:
+            self[field]['hash'] = contents_get_hash(self[field]['contents'], self.hash_algorithm)
+
+    def hash_files(self):
+        """
+        Hash the files without a (logged) hash yet block by block, without keeping their contents
+        Doesn't fire any hooks, so it's safe to call this from a thread pool
+        """
+        for field in FIELDS:
+            if 'path' in self[field] and 'hash' not in self[field]:
+                self[field]['hash'] = file_get_hash(self[field]['path'], self.hash_algorithm)
+
+    def read_files(self):
+        """
+        Read the raw contents of the meta and page file and hash those without a (logged) hash yet
+        Doesn't fire any hooks, so it's safe to call this from a thread pool
+        """
+        if self.files_read:
+            return
+        self.files_read = True
+
+        # A meta loaded on its own is loaded again from the contents passed through before_load
+        self['meta'].pop('loaded', None)
+        for field in FIELDS:
+            if 'path' in self[field]:
+                self._read_file(field)
+
+    def read(self):
+        """
+        Read the raw files (see read_files) and fire the before_load hook on the pair
+        Pairs are read on their own only on lazy access, the Builder reads them batch by batch (see read_entries)
+        """
+        read_entries([self])
+
+    def load(self, field, loaded=None, emit=True):
+        """
+        Load the given field with a suitable loader, loading the page will also load the meta
+        Pass loaded if the contents have already been converted elsewhere (i.e. by a process pool)
+        Without emit, the after_load hook is left to the caller (i.e. to fire it on a whole batch, see load_pages)
+        """
+        if 'loaded' in self[field] or 'path' not in self[field]:
+            return
+        if field == 'meta' and not self.is_read:
+            # The meta alone doesn't need the page, nor the hooks
+            if 'contents' not in self['meta']:
+                self._read_file('meta')
+        else:
+            self.read()
+
+        if loaded is None:
+            # Find suitable loaders for meta and page contents
+            loader_class = find_loader_for_ext(self[field]['type'])
+            cache_key = parse_cache.key(loader_class, self[field]['contents']) if parse_cache else None
+            loaded = parse_cache.get(cache_key) if cache_key else None
+            if loaded is None:
+                with tracing.span('parse', 'page', page=self.name, field=field):
+                    loaded = loader_class().read(self[field]['contents'])
+                if cache_key:
+                    parse_cache.put(cache_key, loaded)
+
+        self[field]['loaded'] = loaded
+        self[field].release()
+
+        # Call after_load hooks after the actual loader has loaded the files
+        # This hook is fired, as soon as both, meta and page are loaded
+        if field == 'page' and self.is_pair():
+            self.load('meta')
+            if emit:
+                self._emit(HOOK_AFTER_LOAD)
+                self['meta'].release()
+
+    def release(self, page=False):
+        """
+        Drop the raw bytes of both files, i.e. for pairs that won't be built
+        With page, the converted page is dropped as well (i.e. once it has been written),
+        the files are read again (firing before_load again) and the page is loaded again on access
+        """
+        for field in FIELDS:
+            self[field].release()
+
+        if page:
+            self['page'].pop('loaded', None)
+            self.files_read = self.is_read = False
+
+
+def _emit_batch(hook, raw_entries):
+    """
+    Fire a hook on the given pairs at once (see hooks.emit_hook_batch)
+    """
+    if not raw_entries:
+        return
+    results = emit_hook_batch(hook, raw_entries)
+    for raw_entry, result in zip(raw_entries, results or []):
+        if result is not None and result is not raw_entry:
+            # Plugin returned a new pair instead of modifying the given one
+            for field in FIELDS:
+                raw_entry[field].update(result[field])
+
+
+def read_entries(raw_entries, workers=1):
+    """
+    Read the given RawEntry pairs, fanning out file reads and hashing to a thread pool
+    The before_load hook is fired afterwards in the main process, once for all pairs read (in their order)
+    """
+    if workers > 1 and len(raw_entries) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as io_pool:
+            list(io_pool.map(RawEntry.read_files, raw_entries))
+
+    pending = [e for e in raw_entries if not e.is_read]
+    for raw_entry in pending:
+        raw_entry.is_read = True
+        raw_entry.read_files()
+
+    # Call before_load hooks before the actual loader loads the files
+    # This hook is fired, as soon as we've collected both, meta and page information
+    _emit_batch(HOOK_BEFORE_LOAD, [e for e in pending if e.is_pair()])
+
+
+def load_pages(raw_entries, workers=1):
+    """
+    Convert the pages of the given RawEntry pairs up front instead of on access
+    Pages found in the parse cache are taken from there, the others are converted in a process pool.
+    Results are applied in the order of the given pairs, so the outcome doesn't depend on the number of workers.
+    The before_load and after_load hooks are fired once for all pairs (see hooks.emit_hook_batch)
+    """
+    pending = [e for e in raw_entries if 'path' in e['page'] and 'loaded' not in e['page']]
+    read_entries(pending, workers)
+    if workers <= 1 or len(pending) < 2:
+        for raw_entry in pending:
+            raw_entry.load('page', emit=False)
+        _emit_loaded(pending)
+        return
+
+    loaded_pages = {}
+    cache_keys = {}
+    if parse_cache:
+        for raw_entry in pending:
+            cache_keys[raw_entry.name] = parse_cache.key(find_loader_for_ext(raw_entry['page']['type']),
+                                                         raw_entry['page']['contents'])
+            loaded = parse_cache.get(cache_keys[raw_entry.name])
+            if loaded is not None:
+                loaded_pages[raw_entry.name] = loaded
+
+    misses = [e for e in pending if e.name not in loaded_pages]
+    if misses:
+        from concurrent.futures import ProcessPoolExecutor
+        chunk_size = max(1, len(misses) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=min(workers, len(misses))) as pool:
+            converted = pool.map(load_contents,
+                                 [e['page']['type'] for e in misses],
+                                 [e['page']['contents'] for e in misses],
+                                 chunksize=chunk_size)
+            for raw_entry, loaded in zip(misses, converted):
+                loaded_pages[raw_entry.name] = loaded
+                if parse_cache:
+                    parse_cache.put(cache_keys[raw_entry.name], loaded)
+
+    for raw_entry in pending:
+        raw_entry.load('page', loaded_pages[raw_entry.name], emit=False)
+    _emit_loaded(pending)
+
+
+def _emit_loaded(raw_entries):
+    """
+    Fire the after_load hook on the loaded pairs and release their raw meta
+    """
+    pairs = [e for e in raw_entries if e.is_pair()]
+    _emit_batch(HOOK_AFTER_LOAD, pairs)
+    for raw_entry in pairs:
+        raw_entry['meta'].release()
@@ -0,0 +1,209 @@
+import io
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from termcolor import colored
+from exceptions import LogUnknownStoreError
+from helpers import file_write_atomic, safe_create_dir
+
+
+class AStore(ABC):
+    """
+    Abstract class for implementing log store backends
+    A store loads and writes the serialized log entries (see Entry.serialize()).
+    It remembers the rows it has loaded or written, so write() only needs to persist the rows that have changed.
+    """
+    def __init__(self):
+        self.snapshot = {}
+
+    def _changes(self, rows):
+        """
+        Returns the changed rows and the removed file names compared to the last load / write
+        """
+        rows = {row['file']: row for row in rows}
+        changed = [row for file, row in rows.items() if self.snapshot.get(file) != row]
+        removed = [file for file in self.snapshot if file not in rows]
+        self.snapshot = rows
+        return changed, removed
+
+    @abstractmethod
+    def load(self):
+        pass
+
+    @abstractmethod
+    def write(self, rows):
+        pass
+
+
+class JSONStore(AStore):
+    """
+    The whole log as a single JSON array, rewritten atomically on every write
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return []
+
+        with io.open(self.path, 'r', encoding='utf-8') as log_file_open:
+            try:
+                rows = [row for row in json.load(log_file_open) if row]
+            except json.decoder.JSONDecodeError:
+                # Keep the broken log for inspection instead of silently starting over
+                os.replace(self.path, self.path + '.corrupt')
+                print(colored('Log is corrupt, moved it to', 'red'), self.path + '.corrupt',
+                      colored('- every page will be rebuilt', 'red'))
+                return []
+
+        self._changes(rows)
+        return rows
+
+    def write(self, rows):
+        changed, removed = self._changes(rows)
+        if not changed and not removed:
+            return
+        file_write_atomic(self.path, json.dumps(list(self.snapshot.values()), ensure_ascii=False))
+
+
+class SQLiteStore(AStore):
+    """
+    The log in a SQLite database with indexed tables for entries, hashes, dependencies (page references)
+    and output hashes. Only changed rows are written, all of them in one transaction per build.
+    On first use an existing JSON log is migrated.
+    """
+    SCHEMA_VERSION = 1
+    ENTRY_COLUMNS = ['uid', 'version', 'last_modified', 'template']
+    HASH_COLUMNS = ['hash_meta', 'hash_file', 'hash_nav', 'hash_template', 'stat_meta', 'stat_file']
+    OUTPUT_COLUMNS = ['hash_output']
+    JSON_COLUMNS = ['stat_meta', 'stat_file']
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS entries (
+            file TEXT PRIMARY KEY, uid TEXT, version INTEGER, last_modified TEXT, template TEXT, extra TEXT
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS entries_uid ON entries (uid);
+        CREATE TABLE IF NOT EXISTS hashes (
+            file TEXT PRIMARY KEY, hash_meta TEXT, hash_file TEXT, hash_nav TEXT, hash_template TEXT,
+            stat_meta TEXT, stat_file TEXT
+        );
+        CREATE TABLE IF NOT EXISTS dependencies (
+            file TEXT, target TEXT, PRIMARY KEY (file, target)
+        );
+        CREATE INDEX IF NOT EXISTS dependencies_target ON dependencies (target);
+        CREATE TABLE IF NOT EXISTS outputs (
+            file TEXT PRIMARY KEY, hash_output TEXT
+        );
+    '''
+
+    def __init__(self, path, migrate_from=None):
+        super().__init__()
+        self.path = path
+        self.migrate_from = migrate_from
+        # Builds of the build service run in their own thread, but never concurrently
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+
+    def _create_schema(self, rows):
+        """
+        Creates the tables and inserts the given (migrated) rows in a single transaction along with the
+        schema version, so a failed migration is repeated on the next load
+        """
+        with self.connection:
+            # executescript() would commit right away, so the statements are executed one by one
+            self.connection.execute('BEGIN')
+            for statement in self.SCHEMA.split(';'):
+                if statement.strip():
+                    self.connection.execute(statement)
+            self._write_rows(rows, [])
+            self.connection.execute('PRAGMA user_version = {0}'.format(self.SCHEMA_VERSION))
+
+    def _migrate(self):
+        """
+        One-time migration of an existing JSON log, returns its rows
+        """
+        if not self.migrate_from or not os.path.isfile(self.migrate_from):
+            return []
+
+        rows = JSONStore(self.migrate_from).load()
+        print(colored('Migrating log', 'yellow'), self.migrate_from, '->', self.path, '({0} entries)'.format(len(rows)))
+        return rows
+
+    def load(self):
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < self.SCHEMA_VERSION:
+            rows = self._migrate()
+            self._create_schema(rows)
+            self._changes(rows)
+            return rows
+
+        rows = {}
+        for row in self.connection.execute('''
+                SELECT * FROM entries
+                LEFT JOIN hashes USING (file)
+                LEFT JOIN outputs USING (file)
+                ORDER BY entries.rowid'''):
+            loaded = dict(row)
+            for column in self.JSON_COLUMNS:
+                loaded[column] = json.loads(loaded[column]) if loaded[column] else None
+            loaded.update(json.loads(loaded.pop('extra') or '{}'))
+            loaded['references'] = []
+            rows[loaded['file']] = loaded
+
+        for row in self.connection.execute('SELECT file, target FROM dependencies ORDER BY file, target'):
+            rows[row['file']]['references'].append(row['target'])
+
+        rows = list(rows.values())
+        self._changes(rows)
+        return rows
+
+    def _values(self, row, columns):
+        return [row['file']] + [json.dumps(row.get(c)) if c in self.JSON_COLUMNS else row.get(c) for c in columns]
+
+    def write(self, rows):
+        changed, removed = self._changes(rows)
+        if not changed and not removed:
+            return
+
+        with self.connection:
+            self._write_rows(changed, removed)
+
+    def _write_rows(self, changed, removed):
+        """
+        Upserts the changed rows and deletes the removed files within the current transaction
+        """
+        known_columns = set(['file', 'references'] + self.ENTRY_COLUMNS + self.HASH_COLUMNS + self.OUTPUT_COLUMNS)
+
+        def insert(table, columns, values):
+            # Upsert keeps the rowid (and so the order) of existing entries
+            self.connection.executemany('INSERT INTO {0} (file, {1}) VALUES ({2}) ON CONFLICT (file) DO UPDATE SET {3}'.format(
+                table, ', '.join(columns), ', '.join('?' * (len(columns) + 1)),
+                ', '.join('{0} = excluded.{0}'.format(c) for c in columns)), values)
+
+        for table in ['entries', 'hashes', 'dependencies', 'outputs']:
+            self.connection.executemany('DELETE FROM {0} WHERE file = ?'.format(table), [[f] for f in removed])
+
+        insert('entries', self.ENTRY_COLUMNS + ['extra'], [
+            self._values(row, self.ENTRY_COLUMNS) + [json.dumps({k: v for k, v in row.items() if k not in known_columns})]
+            for row in changed])
+        insert('hashes', self.HASH_COLUMNS, [self._values(row, self.HASH_COLUMNS) for row in changed])
+        insert('outputs', self.OUTPUT_COLUMNS, [self._values(row, self.OUTPUT_COLUMNS) for row in changed])
+
+        self.connection.executemany('DELETE FROM dependencies WHERE file = ?', [[row['file']] for row in changed])
+        self.connection.executemany('INSERT INTO dependencies (file, target) VALUES (?, ?)',
+                                    [[row['file'], target] for row in changed for target in row.get('references', [])])
+
+def get_store(log_config):
+    """
+    Returns the store backend given by the log config (backend: json or sqlite)
+    """
+    backend = log_config.get('backend', 'json')
+    json_path = os.path.join(log_config['output_dir'], log_config['file_name'])
+    safe_create_dir(json_path)
+
+    if backend == 'json':
+        return JSONStore(json_path)
+    elif backend == 'sqlite':
+        return SQLiteStore(os.path.join(log_config['output_dir'], log_config.get('db_name', 'log.sqlite')),
+                           migrate_from=json_path)
+    raise LogUnknownStoreError('Unknown log backend {0}'.format(backend))
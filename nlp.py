@@ -1,51 +1,186 @@
-import nltk
-import yaml
-from bs4 import BeautifulSoup
-from langdetect import detect
-from nltk.corpus import stopwords
-from nltk.tokenize import RegexpTokenizer
-from textblob import TextBlob
+# The NLP libraries (nltk, langdetect) are heavy to import,
+# so they are only imported by the functions that need them
+import re
+from collections import Counter
+from html.parser import HTMLParser
+from termcolor import colored
+try:
+    from configuration import config
+except ImportError:
+    pass
 
-config = yaml.safe_load(open('config.yml'))
-tokenizer = RegexpTokenizer(r'\w+')
+TOKEN = re.compile(r'\w+')
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+# langdetect's language codes to nltk's stopword corpus names
+LANGUAGES = {
+    'da': 'danish', 'de': 'german', 'en': 'english', 'es': 'spanish', 'fi': 'finnish', 'fr': 'french',
+    'hu': 'hungarian', 'it': 'italian', 'nl': 'dutch', 'no': 'norwegian', 'pt': 'portuguese',
+    'ru': 'russian', 'sv': 'swedish', 'tr': 'turkish'
+}
+
+# Stopword sets per language, loaded once per process
+_stopwords = {}
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Collects the text of a html document, without the contents of script and style tags
+    """
+    SKIP_TAGS = ['script', 'style']
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
 
 
 def _text_get_lang(text):
-    return detect(text)
+    from langdetect import detect, LangDetectException
+    try:
+        return LANGUAGES.get(detect(text), 'english')
+    except LangDetectException:
+        return 'english'
 
 
-def _text_get_nouns(text):
-    # TODO: Try replacing with nltk as textblob's performance (especially on German) isn't that good..
-    return TextBlob(text).noun_phrases
+def _get_stopwords(language='english'):
+    """
+    Returns the stopword set of the given language, the nltk corpus is only read once per language
+    """
+    if language not in _stopwords:
+        try:
+            from nltk.corpus import stopwords
+            _stopwords[language] = frozenset(stopwords.words(language))
+        except (ImportError, LookupError, OSError):
+            print(colored('No stopwords available for', 'yellow'), language,
+                  colored('(install nltk and run nltk.download(\'stopwords\'))', 'grey'))
+            _stopwords[language] = frozenset()
+    return _stopwords[language]
 
 
 def _clear_html(content):
-    return BeautifulSoup(content, 'lxml').text
+    extractor = _TextExtractor()
+    extractor.feed(content)
+    extractor.close()
+    return ' '.join(extractor.parts)
 
 
-def _remove_stopwords(tokens, language='english'):
-    return list(filter(lambda word: (word not in stopwords.words(language)
-                                     and str(word).isalpha()) and len(word) > config['processing']['min_word_length'], tokens))
+def _remove_stopwords(tokens, stopwords, min_word_length):
+    return [token for token in tokens if len(token) > min_word_length and token.isalpha() and token not in stopwords]
 
 
 def _str_get_tokens(text):
-    return [token.lower() for token in tokenizer.tokenize(text)]
+    return [token.lower() for token in TOKEN.findall(text)]
+
+
+def _text_get_summary(text, word_frequencies, stopwords, min_word_length, sentences=2):
+    """
+    Extractive summary: the sentences with the most frequent (non stopword) words, in their original order
+    """
+    candidates = [s.strip() for s in SENTENCE_END.split(text) if s.strip()]
+    if not word_frequencies or len(candidates) <= sentences:
+        return ' '.join(candidates)
+
+    def score(sentence):
+        tokens = _remove_stopwords(_str_get_tokens(sentence), stopwords, min_word_length)
+        return sum(word_frequencies[t] for t in tokens) / (len(tokens) or 1)
+
+    best = sorted(range(len(candidates)), key=lambda i: score(candidates[i]), reverse=True)[:sentences]
+    return ' '.join(candidates[i] for i in sorted(best))
+
+
+def _text_get_tokens(content, options):
+    """
+    Returns the text of content (html) and its tokens without stopwords, and the stopwords of its language
+    """
+    text = _clear_html(content) if options['clear_html'] else content
+    language = options['language'] if options['language'] != 'auto' else _text_get_lang(text)
+    stopwords = _get_stopwords(language)
+    return text, _remove_stopwords(_str_get_tokens(text), stopwords, options['min_word_length']), stopwords
+
+
+def nlp_tokenize_batch(contents, options):
+    """
+    Returns the tokens (without stopwords) of each of the given html contents, i.e. for the TF-IDF engine
+    """
+    return [_text_get_tokens(content, options)[1] for content in contents]
+
+
+def nlp_process_batch(contents, options):
+    """
+    Extracts keywords and a summary from each of the given html contents
+    Returns a list of (keywords, summary) tuples in the order of contents
+    """
+    results = []
+    for content in contents:
+        text, tokens, stopwords = _text_get_tokens(content, options)
+        word_frequencies = Counter(tokens)
+
+        keywords = [word for word, _ in word_frequencies.most_common(options['keyword_count'])] \
+            if options['extract_keywords'] else []
+        summary = _text_get_summary(text, word_frequencies, stopwords, options['min_word_length'],
+                                    options['summary_sentences']) if options['summarize'] else ''
+        results.append((keywords, summary))
+    return results
+
+
+def nlp_options(clear_html=True, extract_keywords=True, summarize=True):
+    """
+    Returns the processing options given by the config, they are part of the cache key of nlp results
+    """
+    return {
+        'clear_html': clear_html,
+        'extract_keywords': extract_keywords,
+        'summarize': summarize,
+        'language': config['processing'].get('language', 'english'),
+        'min_word_length': config['processing'].get('min_word_length', 2),
+        'keyword_count': config['processing'].get('keyword_count', 10),
+        'summary_sentences': config['processing'].get('summary_sentences', 2),
+        'keyword_engine': config['processing'].get('keyword_engine', 'frequency')
+    }
+
+
+def _map_batches(function, contents, options, workers=1, batch_size=64):
+    """
+    Applies a batch function to the given contents in batches, with workers > 1 the batches are fanned out
+    to a process pool (so function has to be picklable, i.e. defined at module level).
+    Returns the flattened results in the order of contents
+    """
+    batches = [contents[i:i + batch_size] for i in range(0, len(contents), batch_size)]
+    if workers <= 1 or len(batches) < 2:
+        return [result for batch in batches for result in function(batch, options)]
+
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+    with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+        return [result for batch_results in pool.map(function, batches, repeat(options)) for result in batch_results]
+
+
+def nlp_process_pages(contents, options, workers=1):
+    """
+    Returns a list of (keywords, summary) tuples in the order of the given html contents
+    """
+    return _map_batches(nlp_process_batch, contents, options, workers)
 
 
-def _get_word_frequencies(tokens):
-    return nltk.FreqDist(tokens)
+def nlp_tokenize_pages(contents, options, workers=1):
+    """
+    Returns the tokens (without stopwords) of each of the given html contents
+    """
+    return _map_batches(nlp_tokenize_batch, contents, options, workers)
 
 
 def nlp_process(content, clear_html=True, extract_keywords=True, summerize=True):
-    return [], []
-    # content_cleared = _clear_html(content) if clear_html else content
-    #
-    # nouns = _text_get_nouns(content_cleared)
-    #
-    # tokens = _str_get_tokens(content_cleared)
-    # filtered_tokens = _remove_stopwords(tokens)
-    # word_frequencies = _get_word_frequencies(filtered_tokens)
-    #
-    # # TODO: Only use nouns as keywords
-    #
-    # return word_frequencies.most_common(15) if extract_keywords else None, ''
+    return nlp_process_batch([content], nlp_options(clear_html, extract_keywords, summerize))[0]
@@ -1,19 +1,36 @@
 import importlib
 import os
+import pickle
+import sys
 import importlib.util
 from abc import ABC, abstractmethod
 import pkgutil
-from setuptools import find_packages
 from termcolor import colored
+import tracing
 from builder.template import add_template_path
+from helpers import contents_get_hash
 from hooks import HOOK_BEFORE_LOAD, HOOK_AFTER_LOAD
+from loader.cache import ParseCache
+
+# The values of a pair each hook works on, see HookCache
+HOOK_VALUES = {HOOK_BEFORE_LOAD: 'contents', HOOK_AFTER_LOAD: 'loaded'}
 
 
 class Plugin(ABC):
     """
     This abstract meta class is a blueprint for creating own plugins.
     You can override it's abstract methods, i.e. attach your plugin to hooks / callbacks.
+    Set version and raise it with every change of your plugin's output, it's part of the keys of che's caches.
+    Set pure if the hooks' output only depends on the given pair (no clock, no other files, no side effects
+    like derivative requests): che then caches
+    the results of the hooks per input hash and doesn't call them again on unchanged input (see HookCache).
+    Pure plugins must set a version.
     """
+    version = None
+    pure = False
+    # The PluginHandler that installed the plugin
+    handler = None
+
     @abstractmethod
     def install(self):
         pass
@@ -36,6 +53,74 @@ class Plugin(ABC):
     def after_load(self, loaded_content):
         pass
 
+    def before_load_batch(self, pairs):
+        """
+        Gets called with all pairs read at once (i.e. the changed pairs or a batch of pages to be built),
+        override it to share setup costs between the pairs. Calls before_load on each pair by default
+        Returns the pairs
+        """
+        return [self.before_load(pair) for pair in pairs]
+
+    def after_load_batch(self, pairs):
+        """
+        Gets called with all pairs loaded at once, calls after_load on each pair by default
+        Returns the pairs
+        """
+        return [self.after_load(pair) for pair in pairs]
+
+    def derivative(self, source, transform, params, output):
+        """
+        Requests a cached derivative of the source file (i.e. a thumbnail), see builder.derivatives
+        transform(source, target, **params) must be a module level function of your plugin, params must be JSON-able
+        Returns output (the path relative to the output dir) to be referenced in the page
+        """
+        return self.handler.request_derivative(source, transform, params, output, salt=[type(self).__module__, self.version])
+
+
+class HookCache(ParseCache):
+    """
+    Persistent cache of the hook results of pure plugins
+    Keys are hashes over the plugin, its version, the hook and the values of the pair the hook works on
+    (raw contents for before_load, loaded meta and page for after_load), the entries are the values after the hook
+    """
+    @staticmethod
+    def key(plugin, hook, pair):
+        """
+        Returns the cache key for running the hook of plugin on pair
+        """
+        plugin_id = '{0}:{1}:{2}'.format(type(plugin).__module__, plugin.version, hook)
+        values = [pair[field].get(HOOK_VALUES[hook]) for field in ['meta', 'page']]
+        return contents_get_hash(plugin_id.encode('utf-8') + b'\0' + pickle.dumps(values, pickle.HIGHEST_PROTOCOL),
+                                 'sha256')
+
+
+def _pair_get_values(pair, hook):
+    return {field: pair[field][HOOK_VALUES[hook]] for field in ['meta', 'page'] if HOOK_VALUES[hook] in pair[field]}
+
+
+def _pair_set_values(pair, hook, values):
+    for field, value in values.items():
+        pair[field][HOOK_VALUES[hook]] = value
+
+
+def find_packages(path):
+    """
+    Returns the dotted names of all (nested) packages inside path,
+    a lightweight replacement of setuptools.find_packages() which is expensive to import
+    """
+    packages = []
+    for dir_path, dir_names, _ in os.walk(path):
+        dir_names.sort()
+        relative = os.path.relpath(dir_path, path)
+        if relative == os.curdir:
+            continue
+        if not os.path.isfile(os.path.join(dir_path, '__init__.py')):
+            # Subpackages are only found within packages
+            dir_names[:] = []
+            continue
+        packages.append(relative.replace(os.sep, '.'))
+    return packages
+
 
 class PluginHandler:
     """
@@ -44,10 +129,14 @@ class PluginHandler:
     You can process the found plugins before actually installing them, for instance.
     To eventually install the plugins, call the install_plugins() method
     """
-    def __init__(self, plugin_path):
+    def __init__(self, plugin_path, derivatives=None, hook_cache=None):
         self.path = plugin_path
         self.found_modules = []
         self.installed_plugins = []
+        # Derivative cache (see builder.derivatives) offered to the plugins
+        self.derivatives = derivatives
+        # Cache of the hook results of pure plugins (see HookCache)
+        self.hook_cache = hook_cache
 
         # Find plugins right away
         self._find_plugins()
@@ -74,13 +163,40 @@ class PluginHandler:
         for plugin in self.found_modules:
             spec = importlib.util.spec_from_file_location(plugin['module'], plugin['path'])
             plugin_module = importlib.util.module_from_spec(spec)
+            # Registered, so functions of the plugin (i.e. transforms) can be shipped to worker processes
+            sys.modules[plugin['module']] = plugin_module
             spec.loader.exec_module(plugin_module)
             try:
-                self.installed_plugins.append(plugin_module.ChePlugin())
+                installed_plugin = plugin_module.ChePlugin()
+                installed_plugin.handler = self
+                self.installed_plugins.append(installed_plugin)
                 print(colored('Plugin loaded: ', 'green'), plugin['module'])
+                if installed_plugin.pure and installed_plugin.version is None:
+                    print(colored('Pure plugin without a version, its hook results are not cached: ', 'yellow'),
+                          plugin['module'])
             except AttributeError:
                 print(colored('Plugin loading error: ', 'red'), plugin['module'])
 
+    def get_versions(self):
+        """
+        Returns the module names and versions of all installed plugins
+        """
+        return [[type(plugin).__module__, plugin.version] for plugin in self.installed_plugins]
+
+    def request_derivative(self, source, transform, params, output, salt=None):
+        """
+        Requests a derivative from the derivative cache, see Plugin.derivative()
+        """
+        return self.derivatives.request(source, transform, params, output, salt=salt)
+
+    def run_derivatives(self, workers=1):
+        """
+        Generates (or reuses) and publishes all derivatives requested during the build
+        """
+        if self.derivatives:
+            self.derivatives.run(workers)
+            self.derivatives.print_summary()
+
     @staticmethod
     def install_template_path(path):
         """
@@ -88,20 +204,57 @@ class PluginHandler:
         """
         add_template_path(path)
 
-    def _exec_hook(self, hook, *payload):
-        initial_payload = payload
+    def _exec_hook(self, hook, pairs):
+        """
+        Runs the batch hook of each installed plugin on the given pairs
+        Pure plugins are only called for pairs without a cached result, cached results are applied instead
+        """
         for plugin in self.installed_plugins:
-            initial_payload = getattr(plugin, hook)(*initial_payload)
-        return initial_payload
+            with tracing.span(hook, 'plugin', plugin=type(plugin).__module__, pairs=len(pairs)):
+                keys = {}
+                pending = list(range(len(pairs)))
+                if self.hook_cache is not None and plugin.pure and plugin.version is not None:
+                    keys = {i: self.hook_cache.key(plugin, hook, pairs[i]) for i in pending}
+                    pending = []
+                    for i, key in keys.items():
+                        values = self.hook_cache.get(key)
+                        if values is None:
+                            pending.append(i)
+                        else:
+                            _pair_set_values(pairs[i], hook, values)
+
+                if not pending:
+                    continue
+                results = getattr(plugin, hook + '_batch')([pairs[i] for i in pending])
+                for i, result in zip(pending, results):
+                    if result is not None and result is not pairs[i]:
+                        # Plugin returned a new pair instead of modifying the given one
+                        for field in ['meta', 'page']:
+                            pairs[i][field].update(result[field])
+                    if i in keys:
+                        self.hook_cache.put(keys[i], _pair_get_values(pairs[i], hook))
+        return pairs
 
     def before_load(self, *payload):
         """
         Execute before_load hook on all installed plugins
         """
-        return self._exec_hook(HOOK_BEFORE_LOAD, *payload)
+        return self._exec_hook(HOOK_BEFORE_LOAD, [payload[0]])[0]
 
     def after_load(self, *payload):
         """
         Execute after_load hook on all installed plugins
         """
-        return self._exec_hook(HOOK_AFTER_LOAD, *payload)
+        return self._exec_hook(HOOK_AFTER_LOAD, [payload[0]])[0]
+
+    def before_load_batch(self, pairs):
+        """
+        Execute before_load hook on all installed plugins, once for all pairs
+        """
+        return self._exec_hook(HOOK_BEFORE_LOAD, list(pairs))
+
+    def after_load_batch(self, pairs):
+        """
+        Execute after_load hook on all installed plugins, once for all pairs
+        """
+        return self._exec_hook(HOOK_AFTER_LOAD, list(pairs))
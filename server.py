@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from termcolor import colored
+
+
+class BuildQueue:
+    """
+    Coalescing build queue around a build callback
+    Change notifications that arrive while waiting for, or during a build are collected and handled together
+    by the next single incremental build. Only one build runs at a time.
+    """
+    def __init__(self, build, debounce=0.05, history_size=20):
+        self.build = build
+        self.debounce = debounce
+        self.history_size = history_size
+        self.pending = set()
+        self.requested = False
+        self.state = 'idle'
+        self.history = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='che-build-queue', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def notify(self, pages=()):
+        """
+        Queue a build for the given (changed) pages
+        """
+        with self.condition:
+            self.pending.update(pages)
+            self.requested = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.requested:
+                    self.condition.wait()
+
+            # Coalesce bursts of notifications into a single build
+            time.sleep(self.debounce)
+
+            with self.condition:
+                pages = sorted(self.pending)
+                self.pending = set()
+                self.requested = False
+                self.state = 'building'
+
+            started = datetime.now()
+            build_time_start = time.time()
+            error = None
+            built = []
+            try:
+                built = self.build(pages) or []
+            except Exception as e:
+                error = str(e)
+                print(colored('BUILD ERROR', 'red'), e)
+
+            with self.condition:
+                self.state = 'idle'
+                self.history.append({
+                    'started': str(started),
+                    'duration': time.time() - build_time_start,
+                    'notified_pages': pages,
+                    'built_pages': len(built),
+                    'ok': error is None,
+                    'error': error
+                })
+                del self.history[:-self.history_size]
+
+    def status(self):
+        with self.condition:
+            return {
+                'state': self.state,
+                'queued': sorted(self.pending),
+                'build_requested': self.requested,
+                'builds': list(self.history)
+            }
+
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /status   -> state of the build queue and timings of the last builds
+    POST /changed  -> queue a build, optional body: {"pages": ["ueber_uns", ...]}
+    """
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._send_json(200, self.server.queue.status())
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/changed':
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            pages = payload.get('pages', [])
+        except (ValueError, AttributeError):
+            self._send_json(400, {'error': 'Invalid JSON payload'})
+            return
+
+        if not isinstance(pages, list) or not all(isinstance(page, str) for page in pages):
+            self._send_json(400, {'error': 'pages must be a list of page names'})
+            return
+
+        self.server.queue.notify(pages)
+        self._send_json(202, self.server.queue.status())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(build, host='127.0.0.1', port=8765, debounce=0.05):
+    """
+    Runs the local build service until interrupted
+    build is called with the list of notified pages and should return the built pages
+    """
+    queue = BuildQueue(build, debounce=debounce)
+    queue.start()
+
+    server = ThreadingHTTPServer((host, port), BuildRequestHandler)
+    server.queue = queue
+    print(colored('Build service listening on', 'yellow'), 'http://{0}:{1}'.format(host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(colored('Stopped build service', 'yellow'))
+    finally:
+        server.server_close()
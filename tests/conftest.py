@@ -0,0 +1,5 @@
+import os
+import sys
+
+# che is run from the site dir with its modules on the path, the tests import them the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
@@ -0,0 +1,14 @@
+from bench.build import generate_site
+from bench.importtime import measure_import_time
+
+# Only needed by single commands or processing options, never by a no-op build
+LAZY_MODULES = {'nltk', 'mistune', 'htmlmin', 'setuptools', 'html2markdown'}
+
+
+def test_import_che_skips_lazy_modules(tmp_path):
+    generate_site(str(tmp_path), 1)
+
+    total, imports = measure_import_time(str(tmp_path))
+    imported = {name.split('.')[0] for name, _ in imports}
+    assert total > 0
+    assert not imported & LAZY_MODULES
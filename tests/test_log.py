@@ -0,0 +1,98 @@
+import time
+import pytest
+from exceptions import LogEntryNotInLogError
+from log import log
+from log.entry import Entry
+
+
+@pytest.fixture
+def empty_log():
+    """
+    Runs a test on an empty log and restores the log afterwards
+    """
+    saved = dict(log.entries), dict(log.entries_by_uid), {uid: set(files) for uid, files in log.referrers.items()}
+    for index in [log.entries, log.entries_by_uid, log.referrers]:
+        index.clear()
+    yield log
+    for index, contents in zip([log.entries, log.entries_by_uid, log.referrers], saved):
+        index.clear()
+        index.update(contents)
+
+
+def _fill(size, prefix='page'):
+    for i in range(size):
+        log.insert(Entry('{0}{1}'.format(prefix, i)))
+
+
+def _time_per_call(function, args, repeat=5):
+    """
+    Returns the fastest time per call of function over all args, out of repeat runs
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            function(arg)
+        elapsed = (time.perf_counter() - start) / len(args)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _lookup_times(size):
+    _fill(size)
+    names = ['page{0}'.format(i) for i in range(0, size, max(1, size // 1000))][:1000]
+    uids = [log.find(name=name).uid for name in names]
+
+    find_name = _time_per_call(lambda name: log.find(name=name), names)
+    find_uid = _time_per_call(lambda uid: log.find(name=None, uid=uid), uids)
+
+    start = time.perf_counter()
+    _fill(1000, prefix='new')
+    insert = (time.perf_counter() - start) / 1000
+    return find_name, find_uid, insert
+
+
+def test_find_and_insert_scale_flat(empty_log):
+    small = _lookup_times(1000)
+    for index in [log.entries, log.entries_by_uid, log.referrers]:
+        index.clear()
+    large = _lookup_times(100000)
+
+    # Dict lookups: the time per call must not grow with the size of the log (generous margin for timer noise)
+    for operation, small_time, large_time in zip(['find(name)', 'find(uid)', 'insert'], small, large):
+        assert large_time < small_time * 5 + 2e-6, '{0}: {1:.2e}s per call at 1k, {2:.2e}s at 100k'.format(
+            operation, small_time, large_time)
+
+
+def test_remove_keeps_indexes_in_sync(empty_log):
+    _fill(3)
+    target = log.find(name='page0')
+    referrer = log.find(name='page1')
+    log.set_references(referrer, [target.uid])
+    assert log.find_referrers(target) == ['page1']
+
+    log.remove(referrer)
+    assert log.find(name='page1') is None
+    assert log.find(name=None, uid=referrer.uid) is None
+    assert log.find_referrers(target) == []
+    assert set(log.entries) == {'page0', 'page2'}
+    assert set(log.entries_by_uid) == {str(log.find(name=name).uid) for name in ['page0', 'page2']}
+
+    with pytest.raises(LogEntryNotInLogError):
+        log.remove(referrer)
+
+    # An entry with the same file name that isn't the logged one must not remove the logged entry
+    with pytest.raises(LogEntryNotInLogError):
+        log.remove(Entry('page2'))
+    assert log.find(name='page2') is not None
+
+
+def test_insert_after_remove_reuses_name(empty_log):
+    _fill(1)
+    removed = log.find(name='page0')
+    log.remove(removed)
+
+    log.insert(Entry('page0'))
+    assert log.find(name='page0') is not removed
+    assert log.find(name=None, uid=removed.uid) is None
+    assert len(log.entries) == len(log.entries_by_uid) == 1
@@ -0,0 +1,40 @@
+import json
+import pytest
+from log.store import SQLiteStore
+
+ROWS = [{'file': 'page{0}'.format(i), 'uid': 'uid{0}'.format(i), 'version': 1, 'hash_file': 'h{0}'.format(i),
+         'stat_file': [i, 0], 'references': ['uid0']} for i in range(3)]
+
+
+@pytest.fixture
+def json_log(tmp_path):
+    path = tmp_path / 'log.json'
+    path.write_text(json.dumps(ROWS))
+    return str(path)
+
+
+def test_migrated_rows_persist_without_write(tmp_path, json_log):
+    db_path = str(tmp_path / 'log.sqlite')
+    assert SQLiteStore(db_path, migrate_from=json_log).load() == ROWS
+
+    # i.e. the first build failed, so the log was never written
+    rows = SQLiteStore(db_path, migrate_from=json_log).load()
+    assert [(row['file'], row['hash_file'], row['stat_file'], row['references']) for row in rows] == \
+        [(row['file'], row['hash_file'], row['stat_file'], row['references']) for row in ROWS]
+
+
+def test_failed_migration_is_repeated(tmp_path, json_log, monkeypatch):
+    db_path = str(tmp_path / 'log.sqlite')
+
+    def fail(*args):
+        raise RuntimeError('disk full')
+
+    monkeypatch.setattr(SQLiteStore, '_write_rows', fail)
+    with pytest.raises(RuntimeError):
+        SQLiteStore(db_path, migrate_from=json_log).load()
+    monkeypatch.undo()
+
+    store = SQLiteStore(db_path, migrate_from=json_log)
+    assert store.connection.execute('PRAGMA user_version').fetchone()[0] == 0
+    assert store.load() == ROWS
+    assert len(SQLiteStore(db_path).load()) == len(ROWS)
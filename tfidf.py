@@ -0,0 +1,145 @@
+# Optional TF-IDF keyword engine (processing.keyword_engine: 'tfidf'), needs numpy and scipy
+# Only imported by the Builder if the engine is enabled
+import io
+import numpy as np
+import scipy.sparse
+from helpers import file_write_atomic
+
+# Loaded indexes by path, kept in memory by long running processes (watch, serve)
+_indexes = {}
+
+
+class TfidfIndex:
+    """
+    Term counts of all published pages (one sparse row per page) and the document frequency of each term
+
+    Pages are added, replaced and removed one row at a time: only the rows of changed pages are tokenized again
+    and the document frequency vector is updated by subtracting the old and adding the new row, so an update
+    doesn't depend on the size of the site. Scoring the pages to be built is a single vectorized pass
+    over their rows (see top_terms()).
+    Each row carries a key (i.e. the hash of the page contents), rows whose key differs are stale.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.terms = []
+        self.columns = {}
+        self.rows = {}
+        self.df = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads the index from path (npz), a missing or unreadable file results in an empty index
+        """
+        index = cls(path)
+        try:
+            with np.load(path) as stored:
+                index.terms = stored['terms'].tolist()
+                index.columns = {term: column for column, term in enumerate(index.terms)}
+                indptr, indices, counts = stored['indptr'], stored['indices'], stored['counts']
+                for i, (name, key) in enumerate(zip(stored['names'].tolist(), stored['keys'].tolist())):
+                    index.rows[name] = (key, indices[indptr[i]:indptr[i + 1]], counts[indptr[i]:indptr[i + 1]])
+                index.df = np.bincount(indices, minlength=len(index.terms)).astype(np.int64)
+        except (OSError, KeyError, ValueError):
+            pass
+        return index
+
+    def save(self):
+        """
+        Writes the index to its path, terms no page uses anymore are dropped
+        """
+        self._compact()
+        names = list(self.rows)
+        rows = [self.rows[name] for name in names]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row[1]) for row in rows])
+
+        buffer = io.BytesIO()
+        np.savez(buffer,
+                 terms=np.array(self.terms, dtype=str),
+                 names=np.array(names, dtype=str),
+                 keys=np.array([row[0] for row in rows], dtype=str),
+                 indptr=indptr,
+                 indices=np.concatenate([row[1] for row in rows] or [np.zeros(0, dtype=np.int32)]),
+                 counts=np.concatenate([row[2] for row in rows] or [np.zeros(0, dtype=np.int32)]))
+        file_write_atomic(self.path, buffer.getvalue())
+
+    def _compact(self):
+        keep = self.df > 0
+        if keep.all():
+            return
+        remap = np.cumsum(keep) - 1
+        self.terms = [term for term, kept in zip(self.terms, keep) if kept]
+        self.columns = {term: column for column, term in enumerate(self.terms)}
+        self.rows = {name: (key, remap[columns].astype(np.int32), counts) for name, (key, columns, counts) in self.rows.items()}
+        self.df = self.df[keep]
+
+    def sync(self, keys):
+        """
+        Removes the rows of all pages not in keys (page name -> key) and returns the names of pages
+        without an up to date row
+        """
+        for name in [name for name in self.rows if name not in keys]:
+            self.remove_page(name)
+        return [name for name, key in keys.items() if name not in self.rows or self.rows[name][0] != key]
+
+    def set_page(self, name, key, tokens):
+        """
+        Adds or replaces the row of a page
+        """
+        for token in tokens:
+            if token not in self.columns:
+                self.columns[token] = len(self.terms)
+                self.terms.append(token)
+        if len(self.df) < len(self.terms):
+            self.df = np.concatenate([self.df, np.zeros(len(self.terms) - len(self.df), dtype=np.int64)])
+
+        self.remove_page(name)
+        columns, counts = np.unique(np.fromiter((self.columns[t] for t in tokens), dtype=np.int32, count=len(tokens)),
+                                    return_counts=True)
+        self.df[columns] += 1
+        self.rows[name] = (key, columns.astype(np.int32), counts.astype(np.int32))
+
+    def remove_page(self, name):
+        if name in self.rows:
+            self.df[self.rows.pop(name)[1]] -= 1
+
+    def top_terms(self, names, k=10):
+        """
+        Returns the k terms with the highest TF-IDF score of each of the given pages (page name -> terms)
+        """
+        rows = [self.rows[name] for name in names]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row[1]) for row in rows])
+        indices = np.concatenate([row[1] for row in rows] or [np.zeros(0, dtype=np.int32)])
+        counts = np.concatenate([row[2] for row in rows] or [np.zeros(0, dtype=np.int32)]).astype(np.float64)
+        matrix = scipy.sparse.csr_matrix((counts, indices, indptr), shape=(len(rows), len(self.terms)))
+
+        # Smoothed idf, term frequencies normalized by the number of tokens per page
+        idf = np.log((1 + len(self.rows)) / (1 + self.df)) + 1
+        lengths = np.asarray(matrix.sum(axis=1)).ravel()
+        lengths[lengths == 0] = 1
+        scores = (scipy.sparse.diags(1 / lengths) @ matrix @ scipy.sparse.diags(idf)).tocsr()
+
+        # Sort all cells by row and descending score with a single float key (row + 1 - normalized score),
+        # the stable sort keeps ties in column order (first appearance of the term in the site)
+        # and keep the first k cells of each row
+        scores.sort_indices()
+        row_ids = np.repeat(np.arange(len(rows)), np.diff(scores.indptr))
+        order = np.argsort(row_ids + (1 - scores.data / (scores.data.max(initial=0) * (1 + 1e-9) or 1)), kind='stable')
+        ranks = np.arange(len(order)) - scores.indptr[row_ids[order]]
+        top = order[ranks < k]
+
+        result = {name: [] for name in names}
+        for row, column in zip(row_ids[top].tolist(), scores.indices[top].tolist()):
+            result[names[row]].append(self.terms[column])
+        return result
+
+
+def get_index(path):
+    """
+    Returns the index stored at path, loading it only once per process
+    """
+    if path not in _indexes:
+        _indexes[path] = TfidfIndex.load(path)
+    return _indexes[path]
@@ -0,0 +1,120 @@
+# Build tracing: spans of the build phases, plugin hooks and single pages
+# Spans are only recorded once tracing has been enabled (che --trace / --profile),
+# otherwise span() returns a shared no-op span, so instrumented code pays a single call
+import json
+import os
+import threading
+import time
+from termcolor import colored
+
+enabled = False
+_events = []
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ['name', 'category', 'args', 'start']
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        _events.append({
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': self.start * 1e6,
+            'dur': (end - self.start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': self.args
+        })
+        return False
+
+
+def enable(active=True):
+    global enabled
+    enabled = active
+
+
+def span(name, category='phase', **args):
+    """
+    Returns a context manager recording the time spent within it as a span, i.e.
+    with span('render', 'page', page=name): ...
+    """
+    if not enabled:
+        return _NO_SPAN
+    return _Span(name, category, args)
+
+
+def pop_events():
+    """
+    Returns and clears the recorded spans, i.e. to ship the spans of a worker process to the main process
+    """
+    global _events
+    events, _events = _events, []
+    return events
+
+
+def add_events(events):
+    _events.extend(events)
+
+
+def write_chrome_trace(path):
+    """
+    Writes all spans as a Chrome trace (chrome://tracing, Perfetto)
+    """
+    main_pid = os.getpid()
+    metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'che' if pid == main_pid else 'worker'}}
+                for pid in sorted(set(e['pid'] for e in _events))]
+    with open(path, 'w', encoding='utf-8') as trace_file:
+        json.dump({'traceEvents': metadata + _events, 'displayTimeUnit': 'ms'}, trace_file)
+    print(colored('Trace', 'grey'), '-> {0} spans written to {1}'.format(len(_events), path))
+
+
+def _totals(category, key):
+    totals = {}
+    for event in _events:
+        if event['cat'] == category:
+            name = event['args'].get(key, event['name'])
+            count, duration = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, duration + event['dur'] / 1e6)
+    return sorted(totals.items(), key=lambda t: t[1][1], reverse=True)
+
+
+def print_profile(top=10):
+    """
+    Prints the time of each build phase and the top slowest pages (parsing and building) and plugins
+    """
+    print(colored('Profile', 'grey'))
+    for name, (count, duration) in _totals('phase', 'phase'):
+        print('  {0:>9.3f}s  {1}'.format(duration, name) + (' ({0}x)'.format(count) if count > 1 else ''))
+
+    pages = _totals('page', 'page')
+    if pages:
+        print(colored('Slowest pages', 'grey'))
+        for name, (count, duration) in pages[:top]:
+            print('  {0:>9.3f}s  {1}'.format(duration, name))
+
+    plugins = _totals('plugin', 'plugin')
+    if plugins:
+        print(colored('Slowest plugins', 'grey'))
+        for name, (count, duration) in plugins[:top]:
+            print('  {0:>9.3f}s  {1} ({2} hook calls)'.format(duration, name, count))
@@ -0,0 +1,167 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from termcolor import colored
+
+# inotify event mask: modify, attrib, close_write, moved_from, moved_to, create, delete
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def _is_ignored(path, ignore):
+    path = os.path.abspath(path)
+    return any(path == i or path.startswith(i + os.sep) for i in ignore)
+
+
+def _walk_dirs(paths, ignore):
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, _ in os.walk(path):
+                if _is_ignored(dir_path, ignore):
+                    dir_names[:] = []
+                    continue
+                yield dir_path
+
+
+class PollingObserver:
+    """
+    Detects changes by comparing stat snapshots of all files inside the watched paths
+    """
+    def __init__(self, paths, ignore=(), interval=0.1):
+        self.paths = paths
+        self.ignore = ignore
+        self.interval = interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for dir_path in _walk_dirs(self.paths, self.ignore):
+            for dir_entry in os.scandir(dir_path):
+                if dir_entry.is_file():
+                    stat = dir_entry.stat()
+                    snapshot[dir_entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Blocks until files have changed or the timeout is over, returns the set of changed paths
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while deadline is None or time.time() < deadline:
+            time.sleep(self.interval if deadline is None else max(0.0, min(self.interval, deadline - time.time())))
+            snapshot = self._snapshot()
+            changed = {p for p in snapshot.keys() | self.snapshot.keys() if snapshot.get(p) != self.snapshot.get(p)}
+            self.snapshot = snapshot
+            if changed:
+                return changed
+        return set()
+
+
+class InotifyObserver:
+    """
+    Detects changes through the Linux inotify API (directories are watched non-recursively,
+    so every directory inside the watched paths gets its own watch, new directories are watched once they appear)
+    """
+    def __init__(self, paths, ignore=()):
+        self.paths = paths
+        self.ignore = ignore
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        self.watches = {}
+        self._add_watches(paths)
+
+    def _add_watches(self, paths):
+        """
+        Watches all directories inside the given paths, returns the files found in them
+        """
+        files = set()
+        for dir_path in _walk_dirs(paths, self.ignore):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), INOTIFY_MASK)
+            if wd >= 0:
+                self.watches[wd] = dir_path
+            files.update(dir_entry.path for dir_entry in os.scandir(dir_path) if dir_entry.is_file())
+        return files
+
+    def wait(self, timeout=None):
+        """
+        Blocks until files have changed or the timeout is over, returns the set of changed paths
+        If the event queue has overflown, events are lost and the watched paths themselves are returned
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self.paths)
+                continue
+            if mask & IN_IGNORED:
+                # The watched directory has been removed
+                self.watches.pop(wd, None)
+                continue
+
+            path = os.path.join(self.watches.get(wd, ''), os.fsdecode(name))
+            if _is_ignored(path, self.ignore):
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been created in the new directory before it is watched
+                changed.update(self._add_watches([path]))
+        return changed
+
+
+def get_observer(paths, ignore=(), interval=0.1):
+    """
+    Returns an inotify based observer on Linux and falls back to polling anywhere else
+    Changes inside the ignored paths (i.e. output and store directory) are not reported
+    """
+    ignore = [os.path.abspath(i) for i in ignore]
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyObserver(paths, ignore=ignore)
+        except (OSError, AttributeError):
+            pass
+    return PollingObserver(paths, ignore=ignore, interval=interval)
+
+
+def watch(paths, on_change, ignore=(), debounce=0.05, interval=0.1):
+    """
+    Watches the given paths and calls on_change with the set of changed paths
+    Bursts of events are debounced: on_change is called once no further event arrived within the debounce time
+    """
+    observer = get_observer(paths, ignore=ignore, interval=interval)
+    print(colored('Watching for changes in', 'yellow'), ', '.join(paths), colored('({0})'.format(type(observer).__name__), 'grey'))
+
+    try:
+        while True:
+            changed = observer.wait()
+            if not changed:
+                continue
+            while True:
+                more = observer.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            on_change(changed)
+    except KeyboardInterrupt:
+        print(colored('Stopped watching', 'yellow'))